@@ -0,0 +1,197 @@
+"""
+准入控制
+按路由限制在途请求数与等待队列，队列满时快速返回503；
+按用户ID令牌桶限流；数据库写入排队过长时自动降级为不保存
+"""
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+import asyncio
+import math
+import os
+import time
+
+from fastapi import HTTPException, Request, status
+
+from .database import DB_POOL_SIZE, DB_MAX_OVERFLOW
+
+# 计算接口的在途请求上限、等待队列长度与排队超时（秒）
+ADMISSION_CALCULATE_MAX_INFLIGHT = int(os.getenv("ADMISSION_CALCULATE_MAX_INFLIGHT", "64"))
+ADMISSION_CALCULATE_MAX_QUEUE = int(os.getenv("ADMISSION_CALCULATE_MAX_QUEUE", "128"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+
+# 拒绝时建议客户端的重试间隔（秒）
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# 数据库写入并发上限默认与连接池容量一致
+ADMISSION_DB_MAX_INFLIGHT = int(os.getenv("ADMISSION_DB_MAX_INFLIGHT", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+ADMISSION_DB_MAX_QUEUE = int(os.getenv("ADMISSION_DB_MAX_QUEUE", "256"))
+
+# 等待数据库写入的请求数达到该值时跳过保存（0表示不降级）
+DEGRADE_DB_QUEUE_THRESHOLD = int(os.getenv("DEGRADE_DB_QUEUE_THRESHOLD", "32"))
+
+# 每个用户每秒请求数与突发容量（0表示不限流）
+RATE_LIMIT_PER_USER = float(os.getenv("RATE_LIMIT_PER_USER", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+
+# 令牌桶最多跟踪的用户数
+_MAX_BUCKETS = 100000
+
+
+def _overloaded(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="服务繁忙，请稍后重试",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+class RouteLimiter:
+    """单个路由的在途请求上限与有界等待队列"""
+
+    def __init__(self, name: str, max_inflight: int, max_queue: int, queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        # 在事件循环中首次使用时创建
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个执行名额；队列已满或排队超时时抛出503"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise _overloaded(ADMISSION_RETRY_AFTER)
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise _overloaded(ADMISSION_RETRY_AFTER)
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.inflight += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict:
+        return {
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class TokenBucketLimiter:
+    """按键（用户ID）的令牌桶限流"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, list] = {}
+        self.limited = 0
+
+    def acquire(self, key: Optional[str]) -> float:
+        """取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        if self.rate <= 0 or not key:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= _MAX_BUCKETS:
+                self._evict(now)
+            bucket = self._buckets[key] = [float(self.burst), now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        self.limited += 1
+        return (1 - tokens) / self.rate
+
+    def _evict(self, now: float):
+        """清理已经回满的令牌桶"""
+        full_after = self.burst / self.rate
+        for key in [key for key, (_, last) in self._buckets.items() if now - last >= full_after]:
+            del self._buckets[key]
+
+
+limiters: Dict[str, RouteLimiter] = {
+    "calculate": RouteLimiter("calculate", ADMISSION_CALCULATE_MAX_INFLIGHT, ADMISSION_CALCULATE_MAX_QUEUE),
+    "db_write": RouteLimiter("db_write", ADMISSION_DB_MAX_INFLIGHT, ADMISSION_DB_MAX_QUEUE),
+}
+
+user_rate_limiter = TokenBucketLimiter(RATE_LIMIT_PER_USER, RATE_LIMIT_BURST)
+
+degraded_requests = 0
+
+
+def admit(route: str):
+    """路由准入依赖：请求处理期间占用该路由的执行名额"""
+    limiter = limiters[route]
+
+    async def dependency():
+        async with limiter.slot():
+            yield
+
+    return dependency
+
+
+def check_rate_limit(user_id: Optional[str]):
+    """用户限流，超限时抛出429"""
+    wait = user_rate_limiter.acquire(user_id)
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="请求过于频繁，请稍后重试",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))}
+        )
+
+
+async def rate_limit_by_user(request: Request):
+    """
+    按请求体中的 user_id 限流的依赖
+
+    需要声明在 admit() 之前，超限请求不会占用执行名额或排队位置
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        # 请求体无效时交给参数校验返回422
+        return
+    user_id = body.get("user_id") if isinstance(body, dict) else None
+    check_rate_limit(user_id if isinstance(user_id, str) else None)
+
+
+def should_degrade() -> bool:
+    """数据库写入排队过长时跳过保存"""
+    global degraded_requests
+    if DEGRADE_DB_QUEUE_THRESHOLD > 0 and limiters["db_write"].waiting >= DEGRADE_DB_QUEUE_THRESHOLD:
+        degraded_requests += 1
+        return True
+    return False
+
+
+def get_admission_stats() -> Dict:
+    return {
+        **{name: limiter.stats() for name, limiter in limiters.items()},
+        "rate_limited": user_rate_limiter.limited,
+        "degraded": degraded_requests,
+    }
@@ -1,10 +1,24 @@
 """
 八字计算核心算法
-支持：阳历转农历、天干地支计算、四柱推算、五行分析
+支持：阳历转农历、天干地支计算、四柱推算、五行分析、真太阳时校正
 """
 from datetime import datetime, timedelta
+import math
 import pytz
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+def _build_equation_of_time_table() -> List[float]:
+    """
+    预计算每日均时差（分钟），下标为一年中的第几天减1（共366天）
+    
+    近似公式误差在1分钟以内，对时辰划分足够
+    """
+    table = []
+    for day_of_year in range(1, 367):
+        b = 2 * math.pi * (day_of_year - 81) / 364
+        table.append(round(9.87 * math.sin(2 * b) - 7.53 * math.cos(b) - 1.5 * math.sin(b), 2))
+    return table
 
 
 class BaziCalculator:
@@ -37,6 +51,76 @@ class BaziCalculator:
         '偏印': '生我', '正印': '生我'
     }
     
+    # 月干起点（按年干下标）：甲己之年丙作首
+    MONTH_TIAN_BASE = [2, 4, 6, 8, 0, 2, 4, 6, 8, 0]
+    
+    # 时干起点（按日干下标）：甲己还加甲
+    HOUR_TIAN_BASE = [0, 2, 4, 6, 8, 0, 2, 4, 6, 8]
+    
+    # 各小时（0-23）对应的时辰地支下标，23点起为子时
+    HOUR_DIZHI = [0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 0]
+    
+    # 均时差表（分钟）
+    EQUATION_OF_TIME = _build_equation_of_time_table()
+    
+    # 常用出生地经度（东经为正）
+    CITY_LONGITUDES = {
+        '北京': 116.41, '天津': 117.20, '上海': 121.47, '重庆': 106.55,
+        '哈尔滨': 126.53, '长春': 125.32, '沈阳': 123.43, '呼和浩特': 111.75,
+        '石家庄': 114.51, '太原': 112.55, '济南': 117.12, '郑州': 113.63,
+        '西安': 108.94, '兰州': 103.83, '银川': 106.23, '西宁': 101.78,
+        '乌鲁木齐': 87.62, '喀什': 75.99, '拉萨': 91.11, '成都': 104.07,
+        '昆明': 102.83, '贵阳': 106.63, '南宁': 108.37, '广州': 113.26,
+        '深圳': 114.06, '海口': 110.35, '长沙': 112.94, '武汉': 114.31,
+        '南昌': 115.86, '福州': 119.30, '杭州': 120.16, '南京': 118.80,
+        '合肥': 117.23, '香港': 114.17, '澳门': 113.54, '台北': 121.56,
+    }
+    
+    # 日主性格
+    PERSONALITIES = {
+        '甲': "甲木日主，如参天大树，性格刚直，有向上的进取心，富有正义感。做事积极主动，但有时过于倔强。",
+        '乙': "乙木日主，如花草藤蔓，性格柔和，善于适应环境，心思细腻。为人亲切温和，但有时显得优柔寡断。",
+        '丙': "丙火日主，如太阳之火，性格热情开朗，充满活力，善于表达。做事光明磊落，但有时过于冲动。",
+        '丁': "丁火日主，如灯烛之火，性格温和细腻，内心热情，善于思考。为人谨慎周到，但有时过于敏感。",
+        '戊': "戊土日主，如高山厚土，性格稳重可靠，包容力强，诚实守信。做事踏实，但有时过于固执。",
+        '己': "己土日主，如田园之土，性格温和谦逊，善于协调，注重实际。为人和善，但有时过于保守。",
+        '庚': "庚金日主，如刚铁利剑，性格刚毅果断，有魄力和决断力。做事干脆利落，但有时过于刚硬。",
+        '辛': "辛金日主，如珠玉首饰，性格细腻敏锐，追求完美，有审美品味。为人精致，但有时过于挑剔。",
+        '壬': "壬水日主，如江河之水，性格灵活变通，智慧聪明，善于交际。思维活跃，但有时过于多变。",
+        '癸': "癸水日主，如雨露甘泉，性格温柔细腻，内敛深沉，富有想象力。为人含蓄，但有时过于敏感。"
+    }
+    
+    # 运势建议：颜色、方位（按最弱五行）与职业（按日主五行）
+    COLOR_MAP = {'木': '绿色、青色', '火': '红色、紫色', '土': '黄色、棕色', '金': '白色、金色', '水': '黑色、蓝色'}
+    DIRECTION_MAP = {'木': '东方', '火': '南方', '土': '中央', '金': '西方', '水': '北方'}
+    CAREER_MAP = {
+        '木': '文教、医疗、林业、纺织',
+        '火': '能源、娱乐、餐饮、电子',
+        '土': '房地产、建筑、农业、管理',
+        '金': '金融、机械、科技、法律',
+        '水': '贸易、物流、旅游、通讯'
+    }
+    
+    # 解读文本模板
+    INTERPRETATION_TEMPLATES = {
+        'basic': "您的日主为{rigan}，五行属{rigan_wuxing}。",
+        'wuxing_item': "{wuxing}有{count}个",
+        'wuxing_distribution': "您的八字中，{items}。",
+        'wuxing_balance': "五行中{strongest}最旺，{weakest}最弱。",
+        'personality_default': "性格随和，为人处世有自己的特点。",
+        'xiyongshen_balanced': "您的八字五行较为平衡，日常可多接触{rigan_wuxing}相关的事物。",
+        'xiyongshen': "根据您的八字，建议以{elements}为喜用神，可在生活中多接触相关颜色、方位、职业等。",
+        'xiyongshen_weak': "建议以{element}为喜用神，可在生活中多接触{element}相关的事物。",
+        'advice_color': "颜色方面：可多穿戴{color}系的衣物，有助于平衡五行。",
+        'advice_direction': "方位方面：{direction}为您的有利方位。",
+        'advice_career': "事业方面：适合从事{career}相关行业。",
+        'full_text': "{basic}\n\n{wuxing_distribution}{wuxing_balance}\n\n【性格特征】\n{personality}\n\n【喜用神】\n{xiyongshen}\n\n【建议】\n{advice}",
+    }
+    
+    # 喜用神：个数不超过 XIYONG_WEAK_MAX 的五行为弱，不少于 XIYONG_STRONG_MIN 的为强
+    XIYONG_WEAK_MAX = 1
+    XIYONG_STRONG_MIN = 3
+    
     # 五行相生相克
     WUXING_SHENG = {'木': '火', '火': '土', '土': '金', '金': '水', '水': '木'}
     WUXING_KE = {'木': '土', '土': '水', '水': '火', '火': '金', '金': '木'}
@@ -68,8 +152,7 @@ class BaziCalculator:
         
         # 月干由年干推算：甲己之年丙作首
         year_tian = (year - 4) % 10
-        month_tian_base = {0: 2, 1: 4, 2: 6, 3: 8, 4: 0, 5: 2, 6: 4, 7: 6, 8: 8, 9: 0}
-        month_tian_index = (month_tian_base[year_tian] + month - 1) % 10
+        month_tian_index = (BaziCalculator.MONTH_TIAN_BASE[year_tian] + month - 1) % 10
         
         return BaziCalculator.TIANGAN[month_tian_index] + BaziCalculator.DIZHI[month_dizhi_index]
     
@@ -81,7 +164,8 @@ class BaziCalculator:
         base_tian = 4  # 戊
         base_di = 6    # 午
         
-        days_diff = (date - base_date).days
+        # 按出生地当地日期计算，忽略时区信息
+        days_diff = (date.replace(tzinfo=None) - base_date).days
         
         tian_index = (base_tian + days_diff) % 10
         di_index = (base_di + days_diff) % 12
@@ -91,39 +175,74 @@ class BaziCalculator:
     @staticmethod
     def calculate_ganzhi_hour(hour: int, day_tian: str) -> str:
         """计算时柱天干地支"""
-        # 时辰地支
-        hour_dizhi_map = {
-            23: 0, 0: 0,  # 子时
-            1: 1, 2: 1,   # 丑时
-            3: 2, 4: 2,   # 寅时
-            5: 3, 6: 3,   # 卯时
-            7: 4, 8: 4,   # 辰时
-            9: 5, 10: 5,  # 巳时
-            11: 6, 12: 6, # 午时
-            13: 7, 14: 7, # 未时
-            15: 8, 16: 8, # 申时
-            17: 9, 18: 9, # 酉时
-            19: 10, 20: 10, # 戌时
-            21: 11, 22: 11  # 亥时
-        }
-        
-        hour_di_index = hour_dizhi_map.get(hour, 0)
+        hour_di_index = BaziCalculator.HOUR_DIZHI[hour % 24]
         
         # 时干由日干推算：甲己还加甲
         day_tian_index = BaziCalculator.TIANGAN.index(day_tian)
-        hour_tian_base = {0: 0, 1: 2, 2: 4, 3: 6, 4: 8, 5: 0, 6: 2, 7: 4, 8: 6, 9: 8}
-        hour_tian_index = (hour_tian_base[day_tian_index] + hour_di_index) % 10
+        hour_tian_index = (BaziCalculator.HOUR_TIAN_BASE[day_tian_index] + hour_di_index) % 10
         
         return BaziCalculator.TIANGAN[hour_tian_index] + BaziCalculator.DIZHI[hour_di_index]
     
     @staticmethod
-    def calculate_bazi(birth_datetime: datetime, timezone_str: str = 'Asia/Shanghai') -> Dict:
+    def resolve_longitude(longitude: Optional[float] = None, birth_place: Optional[str] = None) -> Optional[float]:
+        """确定出生地经度：优先使用经度，其次按出生地查表"""
+        if longitude is not None:
+            return longitude
+        if birth_place:
+            if birth_place not in BaziCalculator.CITY_LONGITUDES:
+                raise ValueError(f"未知出生地: {birth_place}")
+            return BaziCalculator.CITY_LONGITUDES[birth_place]
+        return None
+    
+    @staticmethod
+    def standard_meridian(local_datetime: datetime) -> float:
+        """
+        钟表时间对应的经线：出生时刻实际生效的UTC偏移（含夏令时）
+        
+        夏令时期间钟表快一小时，经线相应东移15度，校正时才能把这一小时减掉
+        """
+        return local_datetime.utcoffset().total_seconds() / 240
+    
+    @staticmethod
+    def true_solar_offsets(
+        longitudes: Sequence[float],
+        meridians: Sequence[float],
+        days_of_year: Sequence[int]
+    ) -> List[float]:
+        """
+        批量计算真太阳时与钟表时间之差（分钟）
+        
+        差值 = 经度差 × 4分钟/度 + 均时差（查表）
+        """
+        table = BaziCalculator.EQUATION_OF_TIME
+        return [
+            (longitude - meridian) * 4 + table[day_of_year - 1]
+            for longitude, meridian, day_of_year in zip(longitudes, meridians, days_of_year)
+        ]
+    
+    @staticmethod
+    def to_true_solar_time(local_datetimes: Sequence[datetime], longitudes: Sequence[float]) -> List[datetime]:
+        """批量把带时区的当地时间校正为真太阳时"""
+        offsets = BaziCalculator.true_solar_offsets(
+            longitudes,
+            [BaziCalculator.standard_meridian(dt) for dt in local_datetimes],
+            [dt.timetuple().tm_yday for dt in local_datetimes]
+        )
+        return [dt + timedelta(seconds=round(offset * 60)) for dt, offset in zip(local_datetimes, offsets)]
+    
+    @staticmethod
+    def calculate_bazi(
+        birth_datetime: datetime,
+        timezone_str: str = 'Asia/Shanghai',
+        longitude: Optional[float] = None
+    ) -> Dict:
         """
         计算八字四柱
         
         Args:
             birth_datetime: 出生时间（UTC或本地时间）
             timezone_str: 时区字符串
+            longitude: 出生地经度（可选），提供时日柱和时柱按真太阳时计算
             
         Returns:
             包含四柱、五行等信息的字典
@@ -139,13 +258,17 @@ class BaziCalculator:
         year = birth_datetime.year
         month = birth_datetime.month
         day = birth_datetime.day
-        hour = birth_datetime.hour
+        
+        # 真太阳时校正（只影响日柱和时柱）
+        solar_datetime = birth_datetime
+        if longitude is not None:
+            solar_datetime = BaziCalculator.to_true_solar_time([birth_datetime], [longitude])[0]
         
         # 计算四柱
         year_ganzhi = BaziCalculator.calculate_ganzhi_year(year)
         month_ganzhi = BaziCalculator.calculate_ganzhi_month(year, month, day)
-        day_ganzhi = BaziCalculator.calculate_ganzhi_day(birth_datetime)
-        hour_ganzhi = BaziCalculator.calculate_ganzhi_hour(hour, day_ganzhi[0])
+        day_ganzhi = BaziCalculator.calculate_ganzhi_day(solar_datetime)
+        hour_ganzhi = BaziCalculator.calculate_ganzhi_hour(solar_datetime.hour, day_ganzhi[0])
         
         # 提取天干地支
         sizhu = {
@@ -165,6 +288,8 @@ class BaziCalculator:
         return {
             'birth_time': birth_datetime.isoformat(),
             'timezone': timezone_str,
+            'longitude': longitude,
+            'true_solar_time': solar_datetime.isoformat() if longitude is not None else None,
             'sizhu': sizhu,
             'year_pillar': year_ganzhi,
             'month_pillar': month_ganzhi,
@@ -213,17 +338,18 @@ class BaziCalculator:
         rigan_wuxing = bazi_data['rigan_wuxing']
         wuxing = bazi_data['wuxing_analysis']
         
+        templates = BaziCalculator.INTERPRETATION_TEMPLATES
+        
         # 基础解读
-        basic_interpretation = f"您的日主为{rigan}，五行属{rigan_wuxing}。"
+        basic_interpretation = templates['basic'].format(rigan=rigan, rigan_wuxing=rigan_wuxing)
         
         # 五行分析
-        wuxing_text = "您的八字中，"
-        for wx, count in wuxing['count'].items():
-            wuxing_text += f"{wx}有{count}个，"
-        wuxing_text = wuxing_text.rstrip('，') + "。"
+        wuxing_text = templates['wuxing_distribution'].format(items="，".join(
+            templates['wuxing_item'].format(wuxing=wx, count=count) for wx, count in wuxing['count'].items()
+        ))
         
         # 五行旺衰
-        balance_text = f"五行中{wuxing['strongest']}最旺，{wuxing['weakest']}最弱。"
+        balance_text = templates['wuxing_balance'].format(strongest=wuxing['strongest'], weakest=wuxing['weakest'])
         
         # 性格特征（基于日主）
         personality = BaziCalculator.get_personality_by_rigan(rigan)
@@ -241,35 +367,31 @@ class BaziCalculator:
             'personality': personality,
             'xiyongshen': xiyongshen,
             'advice': advice,
-            'full_text': f"{basic_interpretation}\n\n{wuxing_text}{balance_text}\n\n【性格特征】\n{personality}\n\n【喜用神】\n{xiyongshen}\n\n【建议】\n{advice}"
+            'full_text': templates['full_text'].format(
+                basic=basic_interpretation,
+                wuxing_distribution=wuxing_text,
+                wuxing_balance=balance_text,
+                personality=personality,
+                xiyongshen=xiyongshen,
+                advice=advice
+            )
         }
     
     @staticmethod
     def get_personality_by_rigan(rigan: str) -> str:
         """根据日主分析性格特征"""
-        personalities = {
-            '甲': "甲木日主，如参天大树，性格刚直，有向上的进取心，富有正义感。做事积极主动，但有时过于倔强。",
-            '乙': "乙木日主，如花草藤蔓，性格柔和，善于适应环境，心思细腻。为人亲切温和，但有时显得优柔寡断。",
-            '丙': "丙火日主，如太阳之火，性格热情开朗，充满活力，善于表达。做事光明磊落，但有时过于冲动。",
-            '丁': "丁火日主，如灯烛之火，性格温和细腻，内心热情，善于思考。为人谨慎周到，但有时过于敏感。",
-            '戊': "戊土日主，如高山厚土，性格稳重可靠，包容力强，诚实守信。做事踏实，但有时过于固执。",
-            '己': "己土日主，如田园之土，性格温和谦逊，善于协调，注重实际。为人和善，但有时过于保守。",
-            '庚': "庚金日主，如刚铁利剑，性格刚毅果断，有魄力和决断力。做事干脆利落，但有时过于刚硬。",
-            '辛': "辛金日主，如珠玉首饰，性格细腻敏锐，追求完美，有审美品味。为人精致，但有时过于挑剔。",
-            '壬': "壬水日主，如江河之水，性格灵活变通，智慧聪明，善于交际。思维活跃，但有时过于多变。",
-            '癸': "癸水日主，如雨露甘泉，性格温柔细腻，内敛深沉，富有想象力。为人含蓄，但有时过于敏感。"
-        }
-        return personalities.get(rigan, "性格随和，为人处世有自己的特点。")
+        return BaziCalculator.PERSONALITIES.get(rigan, BaziCalculator.INTERPRETATION_TEMPLATES['personality_default'])
     
     @staticmethod
     def get_xiyongshen(rigan_wuxing: str, wuxing_count: Dict) -> str:
         """推算喜用神"""
         # 简化算法：根据五行平衡推算
-        weak_elements = [wx for wx, count in wuxing_count.items() if count <= 1]
-        strong_elements = [wx for wx, count in wuxing_count.items() if count >= 3]
+        weak_elements = [wx for wx, count in wuxing_count.items() if count <= BaziCalculator.XIYONG_WEAK_MAX]
+        strong_elements = [wx for wx, count in wuxing_count.items() if count >= BaziCalculator.XIYONG_STRONG_MIN]
         
+        templates = BaziCalculator.INTERPRETATION_TEMPLATES
         if not weak_elements:
-            return f"您的八字五行较为平衡，日常可多接触{rigan_wuxing}相关的事物。"
+            return templates['xiyongshen_balanced'].format(rigan_wuxing=rigan_wuxing)
         
         # 找出能生助弱五行的元素
         xiyong = []
@@ -279,9 +401,10 @@ class BaziCalculator:
                     xiyong.append(element)
         
         if xiyong:
-            return f"根据您的八字，建议以{', '.join(set(xiyong))}为喜用神，可在生活中多接触相关颜色、方位、职业等。"
+            # 去重并保持顺序，保证输出稳定
+            return templates['xiyongshen'].format(elements=', '.join(dict.fromkeys(xiyong)))
         else:
-            return f"建议以{weak_elements[0]}为喜用神，可在生活中多接触{weak_elements[0]}相关的事物。"
+            return templates['xiyongshen_weak'].format(element=weak_elements[0])
     
     @staticmethod
     def get_advice(rigan_wuxing: str, wuxing_analysis: Dict) -> str:
@@ -289,37 +412,15 @@ class BaziCalculator:
         strongest = wuxing_analysis['strongest']
         weakest = wuxing_analysis['weakest']
         
-        advice = []
-        
-        # 颜色建议
-        color_map = {
-            '木': '绿色、青色',
-            '火': '红色、紫色',
-            '土': '黄色、棕色',
-            '金': '白色、金色',
-            '水': '黑色、蓝色'
-        }
-        advice.append(f"颜色方面：可多穿戴{color_map[weakest]}系的衣物，有助于平衡五行。")
-        
-        # 方位建议
-        direction_map = {
-            '木': '东方',
-            '火': '南方',
-            '土': '中央',
-            '金': '西方',
-            '水': '北方'
-        }
-        advice.append(f"方位方面：{direction_map[weakest]}为您的有利方位。")
-        
-        # 职业建议
-        career_map = {
-            '木': '文教、医疗、林业、纺织',
-            '火': '能源、娱乐、餐饮、电子',
-            '土': '房地产、建筑、农业、管理',
-            '金': '金融、机械、科技、法律',
-            '水': '贸易、物流、旅游、通讯'
-        }
-        advice.append(f"事业方面：适合从事{career_map[rigan_wuxing]}相关行业。")
+        templates = BaziCalculator.INTERPRETATION_TEMPLATES
+        advice = [
+            # 颜色建议
+            templates['advice_color'].format(color=BaziCalculator.COLOR_MAP[weakest]),
+            # 方位建议
+            templates['advice_direction'].format(direction=BaziCalculator.DIRECTION_MAP[weakest]),
+            # 职业建议
+            templates['advice_career'].format(career=BaziCalculator.CAREER_MAP[rigan_wuxing]),
+        ]
         
         return '\n'.join(advice)
 
@@ -330,7 +431,9 @@ def calculate_bazi_from_input(
     day: int, 
     hour: int, 
     minute: int = 0,
-    timezone_str: str = 'Asia/Shanghai'
+    timezone_str: str = 'Asia/Shanghai',
+    longitude: Optional[float] = None,
+    birth_place: Optional[str] = None
 ) -> Dict:
     """
     从用户输入计算八字
@@ -342,12 +445,15 @@ def calculate_bazi_from_input(
         hour: 小时 (0-23)
         minute: 分钟 (0-59)
         timezone_str: 时区
+        longitude: 出生地经度（可选，启用真太阳时）
+        birth_place: 出生地（可选，未提供经度时查表）
         
     Returns:
         完整的八字分析结果
     """
     birth_datetime = datetime(year, month, day, hour, minute)
-    bazi_data = BaziCalculator.calculate_bazi(birth_datetime, timezone_str)
+    longitude = BaziCalculator.resolve_longitude(longitude, birth_place)
+    bazi_data = BaziCalculator.calculate_bazi(birth_datetime, timezone_str, longitude)
     interpretation = BaziCalculator.get_interpretation(bazi_data)
     
     return {
@@ -355,3 +461,27 @@ def calculate_bazi_from_input(
         'interpretation': interpretation
     }
 
+
+# 真太阳时参考用例：(年, 月, 日, 时, 分, 时区, 经度, 期望真太阳时, 期望时柱)
+# 按 UTC + 经度 × 4分钟 + 均时差 独立核算
+SOLAR_TIME_REFERENCE_CASES = [
+    # 纽约夏令时（UTC-4）
+    (2020, 7, 1, 12, 0, 'America/New_York', -74.0, '2020-07-01T11:00:17-04:00', '壬午'),
+    # 中国1990年夏令时（UTC+9），乌鲁木齐
+    (1990, 5, 15, 12, 0, 'Asia/Shanghai', 87.62, '1990-05-15T08:54:14+09:00', '庚辰'),
+    # 非夏令时，乌鲁木齐
+    (1990, 1, 15, 12, 0, 'Asia/Shanghai', 87.62, '1990-01-15T09:41:11+08:00', '辛巳'),
+]
+
+
+if __name__ == "__main__":
+    import sys
+    
+    failed = 0
+    for year, month, day, hour, minute, timezone_str, longitude, expected_time, expected_hour in SOLAR_TIME_REFERENCE_CASES:
+        result = calculate_bazi_from_input(year, month, day, hour, minute, timezone_str, longitude)
+        ok = result['true_solar_time'] == expected_time and result['hour_pillar'] == expected_hour
+        failed += not ok
+        print(f"{'✅' if ok else '❌'} {timezone_str} {year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d} "
+              f"经度{longitude}: {result['true_solar_time']} {result['hour_pillar']}（期望 {expected_time} {expected_hour}）")
+    sys.exit(1 if failed else 0)
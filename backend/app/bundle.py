@@ -0,0 +1,244 @@
+"""
+离线数据包
+把排盘与基础解读所需的全部数据表（六十甲子、节气边界、干支五行、均时差、解读文案）
+打包为紧凑的JSON，并附带由 BaziCalculator 生成的一致性测试向量，供客户端本地排盘
+
+数据包内容不变则版本号不变（内容哈希），按版本号的地址可永久缓存
+
+导出静态文件：python -m app.bundle --out ./static/bundle
+"""
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+
+from .bazi_calculator import BaziCalculator, SOLAR_TIME_REFERENCE_CASES, calculate_bazi_from_input
+
+# 数据包格式版本（结构变化时递增，客户端据此判断能否解析）
+BUNDLE_FORMAT = 1
+
+# 测试向量数量与随机种子（固定种子保证向量稳定）
+BUNDLE_VECTOR_COUNT = 200
+_VECTOR_SEED = 20240101
+
+# 向量覆盖的时区及其经度范围：以默认时区为主，包含实行夏令时的时区
+_VECTOR_TIMEZONES = {
+    'Asia/Shanghai': (73.0, 135.0),
+    'Asia/Urumqi': (73.0, 96.0),
+    'Asia/Tokyo': (129.0, 146.0),
+    'America/New_York': (-80.0, -67.0),
+    'Europe/London': (-6.0, 2.0),
+}
+_VECTOR_TIMEZONE_WEIGHTS = [6, 1, 1, 1, 1]
+
+WUXING_ORDER = ['木', '火', '土', '金', '水']
+
+
+class BundleFile:
+    """序列化后的数据包文件：原始字节、预压缩字节与ETag"""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+        self.sha256 = hashlib.sha256(content).hexdigest()
+        self.etag = f'"{self.sha256[:32]}"'
+
+    def info(self) -> Dict:
+        return {"size": len(self.content), "gzip_size": len(self.gzipped), "sha256": self.sha256}
+
+
+def _dumps(content) -> bytes:
+    """紧凑、键有序的JSON，相同内容总是得到相同字节"""
+    return json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def build_bundle_data() -> Dict:
+    """
+    数据包内容
+
+    干支、五行均以下标表示（天干0-9、地支0-11、五行按 wuxing 顺序0-4），
+    六十甲子下标 i 对应天干 i%10、地支 i%12
+    """
+    calc = BaziCalculator
+    tiangan, dizhi = calc.TIANGAN, calc.DIZHI
+    wuxing_index = {element: index for index, element in enumerate(WUXING_ORDER)}
+
+    return {
+        "format": BUNDLE_FORMAT,
+        "tiangan": tiangan,
+        "dizhi": dizhi,
+        "jiazi": [tiangan[i % 10] + dizhi[i % 12] for i in range(60)],
+        "wuxing": WUXING_ORDER,
+        "tiangan_wuxing": [wuxing_index[calc.WUXING[gan]] for gan in tiangan],
+        "dizhi_wuxing": [wuxing_index[calc.WUXING[zhi]] for zhi in dizhi],
+        "wuxing_sheng": [wuxing_index[calc.WUXING_SHENG[element]] for element in WUXING_ORDER],
+        "wuxing_ke": [wuxing_index[calc.WUXING_KE[element]] for element in WUXING_ORDER],
+        "calendar": {
+            # 年柱按公历年份：(年 - base_year) 对应六十甲子下标
+            "year": {"base_year": 1984, "base_jiazi": 0},
+            # 月柱：立春（year_start 月/日）之前按上一年的13、14月计；
+            # 地支下标 = (月 + 1) % 12，天干下标 = (tian_base[(年 - 4) % 10] + 月 - 1) % 10
+            "month": {
+                "year_start": [2, 4],
+                "tian_base": calc.MONTH_TIAN_BASE,
+            },
+            # 日柱：按（真太阳时校正后的）当地日期与基准日的天数差
+            "day": {"base_date": "2000-01-01", "base_jiazi": 54},
+            # 时柱：地支下标按小时查 hour_dizhi，天干下标 = (tian_base[日干] + 地支下标) % 10
+            "hour": {
+                "hour_dizhi": calc.HOUR_DIZHI,
+                "tian_base": calc.HOUR_TIAN_BASE,
+            },
+        },
+        # 节气边界：与服务端计算一致，使用固定日期的简化边界
+        "solar_terms": [{"name": "立春", "month": 2, "day": 4}],
+        "true_solar_time": {
+            # 差值（分钟）= (经度 - 时区经线) × 4 + equation_of_time[年内第几天 - 1]；
+            # 时区经线 = 出生时刻实际生效的UTC偏移（分钟，含夏令时）/ 4；结果按秒取整
+            "minutes_per_degree": 4,
+            "equation_of_time": calc.EQUATION_OF_TIME,
+            "cities": calc.CITY_LONGITUDES,
+        },
+        # 五行计数：四柱的天干、地支各计一次；最旺/最弱取计数最大/最小者，相同时按 wuxing 顺序取靠前的
+        "wuxing_tie_break": list(range(len(WUXING_ORDER))),
+        "interpretation": {
+            # 喜用神：计数 <= weak_max 的为弱、>= strong_min 的为强（均按 wuxing 顺序）；
+            # 依次取生弱五行且自身不强的五行，去重后以 separator 连接填入 xiyongshen 模板；
+            # 没有弱五行用 xiyongshen_balanced，有弱五行但无可用五行时用第一个弱五行填 xiyongshen_weak
+            "xiyongshen": {
+                "weak_max": calc.XIYONG_WEAK_MAX,
+                "strong_min": calc.XIYONG_STRONG_MIN,
+                "separator": ", ",
+            },
+            # 五行分布逐项用 wuxing_item 生成后以 separator 连接；建议按颜色、方位（最弱五行）、职业（日主五行）三行
+            "wuxing_item_separator": "，",
+            "advice_separator": "\n",
+            "personalities": [calc.PERSONALITIES[gan] for gan in tiangan],
+            "colors": [calc.COLOR_MAP[element] for element in WUXING_ORDER],
+            "directions": [calc.DIRECTION_MAP[element] for element in WUXING_ORDER],
+            "careers": [calc.CAREER_MAP[element] for element in WUXING_ORDER],
+            # 模板占位符为 {name} 形式
+            "templates": calc.INTERPRETATION_TEMPLATES,
+        },
+    }
+
+
+def _vector_inputs(count: int) -> List[Tuple]:
+    """测试输入：边界用例 + 固定种子的随机用例"""
+    inputs = [
+        # 立春前后、跨年、子时（23点）与子正、以及真太阳时跨日
+        (1984, 2, 3, 12, 0, 'Asia/Shanghai', None),
+        (1984, 2, 4, 12, 0, 'Asia/Shanghai', None),
+        (1999, 12, 31, 23, 30, 'Asia/Shanghai', None),
+        (2000, 1, 1, 0, 0, 'Asia/Shanghai', None),
+        (2000, 1, 1, 0, 30, 'Asia/Shanghai', 87.62),
+        (1990, 6, 15, 12, 0, 'Asia/Shanghai', 87.62),
+        (1990, 6, 15, 23, 50, 'Asia/Shanghai', 126.53),
+        (2024, 2, 29, 6, 15, 'Asia/Shanghai', 121.47),
+        (2023, 12, 31, 22, 59, 'Asia/Shanghai', 75.99),
+        # 夏令时期间的真太阳时（时区经线含夏令时）
+        (2021, 3, 14, 3, 30, 'America/New_York', -71.06),
+        (2021, 11, 7, 1, 30, 'America/New_York', -77.04),
+        (2019, 8, 20, 23, 40, 'Europe/London', -0.13),
+    ]
+    inputs += [case[:7] for case in SOLAR_TIME_REFERENCE_CASES]
+    rng = random.Random(_VECTOR_SEED)
+    cities = sorted(BaziCalculator.CITY_LONGITUDES.values())
+    timezones = list(_VECTOR_TIMEZONES)
+    while len(inputs) < count:
+        timezone_str = rng.choices(timezones, weights=_VECTOR_TIMEZONE_WEIGHTS)[0]
+        longitude = None
+        if rng.random() < 0.5:
+            if timezone_str == 'Asia/Shanghai' and rng.random() < 0.7:
+                longitude = rng.choice(cities)
+            else:
+                longitude = round(rng.uniform(*_VECTOR_TIMEZONES[timezone_str]), 2)
+        inputs.append((
+            rng.randint(1900, 2100),
+            rng.randint(1, 12),
+            rng.randint(1, 28),
+            rng.randint(0, 23),
+            rng.randint(0, 59),
+            timezone_str,
+            longitude,
+        ))
+    return inputs
+
+
+def build_vectors(count: int = BUNDLE_VECTOR_COUNT) -> List[Dict]:
+    """由 BaziCalculator 生成一致性测试向量"""
+    vectors = []
+    for year, month, day, hour, minute, timezone_str, longitude in _vector_inputs(count):
+        result = calculate_bazi_from_input(year, month, day, hour, minute, timezone_str, longitude)
+        wuxing = result['wuxing_analysis']
+        vectors.append({
+            "input": {
+                "year": year, "month": month, "day": day, "hour": hour, "minute": minute,
+                "timezone": timezone_str, "longitude": longitude,
+            },
+            "expected": {
+                "pillars": [result['year_pillar'], result['month_pillar'], result['day_pillar'], result['hour_pillar']],
+                "true_solar_time": result['true_solar_time'],
+                "wuxing_count": [wuxing['count'][element] for element in WUXING_ORDER],
+                "strongest": wuxing['strongest'],
+                "weakest": wuxing['weakest'],
+                "interpretation": result['interpretation'],
+            },
+        })
+    return vectors
+
+
+class Bundle:
+    """当前版本的数据包与测试向量"""
+
+    def __init__(self, data: Dict, vectors: List[Dict]):
+        self.data = BundleFile(_dumps(data))
+        self.vectors = BundleFile(_dumps({"format": BUNDLE_FORMAT, "vectors": vectors}))
+        # 版本号覆盖数据与向量：任一变化都会得到新的地址
+        self.version = hashlib.sha256(
+            (self.data.sha256 + self.vectors.sha256).encode("ascii")
+        ).hexdigest()[:16]
+
+    def file(self, name: str) -> Optional[BundleFile]:
+        return {"data": self.data, "vectors": self.vectors}.get(name)
+
+    def manifest(self, prefix: str = "/api/v1/bundle") -> Dict:
+        return {
+            "format": BUNDLE_FORMAT,
+            "version": self.version,
+            "data": {"url": f"{prefix}/{self.version}.json", **self.data.info()},
+            "vectors": {"url": f"{prefix}/{self.version}/vectors.json", **self.vectors.info()},
+        }
+
+
+@lru_cache(maxsize=1)
+def get_bundle() -> Bundle:
+    """进程内只构建一次"""
+    return Bundle(build_bundle_data(), build_vectors())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导出离线数据包静态文件（可直接部署到CDN）")
+    parser.add_argument("--out", required=True, help="输出目录")
+    parser.add_argument("--prefix", default="", help="manifest 中文件地址的前缀")
+    args = parser.parse_args()
+
+    bundle = get_bundle()
+    os.makedirs(os.path.join(args.out, bundle.version), exist_ok=True)
+    files = {
+        f"{bundle.version}.json": bundle.data,
+        f"{bundle.version}/vectors.json": bundle.vectors,
+    }
+    for name, bundle_file in files.items():
+        path = os.path.join(args.out, name)
+        with open(path, "wb") as f:
+            f.write(bundle_file.content)
+        with open(path + ".gz", "wb") as f:
+            f.write(bundle_file.gzipped)
+    with open(os.path.join(args.out, "manifest.json"), "wb") as f:
+        f.write(_dumps(bundle.manifest(args.prefix.rstrip("/"))))
+    print(f"✅ 数据包导出完成，版本 {bundle.version}（{bundle.data.info()['gzip_size']} 字节，gzip）")
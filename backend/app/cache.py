@@ -0,0 +1,208 @@
+"""
+记录查询缓存
+按字节数限制大小的LRU缓存，存放已序列化的响应；
+多个worker之间通过共享的SQLite文件同步失效
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+RECORD_CACHE_MAX_BYTES = int(os.getenv("RECORD_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RECORD_CACHE_SYNC_PATH = os.getenv(
+    "RECORD_CACHE_SYNC_PATH",
+    os.path.join(tempfile.gettempdir(), "bazi_cache_invalidation.sqlite3")
+)
+
+# 失效后多少秒内回源到主库（应大于副本的最大复制延迟）
+RECORD_CACHE_PRIMARY_WINDOW = float(os.getenv("RECORD_CACHE_PRIMARY_WINDOW", "10"))
+
+# 失效日志保留时间（秒）
+_LOG_RETENTION = 3600
+
+
+def record_tag(record_id: int) -> str:
+    return f"record:{record_id}"
+
+
+def user_tag(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+class InvalidationChannel:
+    """基于SQLite文件的失效广播通道
+
+    每个worker写入失效标签，读取时先检查文件修改时间，
+    只有文件变化后才查询新增的失效记录。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS invalidations ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, tag TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.commit()
+        self._last_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM invalidations").fetchone()[0]
+        self._mtime = self._stat()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def _stat(self) -> int:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return 0
+
+    def publish(self, tags: Iterable[str]):
+        """写入失效标签"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO invalidations (tag, created) VALUES (?, ?)",
+                [(tag, now) for tag in tags]
+            )
+            conn.execute("DELETE FROM invalidations WHERE created < ?", (now - _LOG_RETENTION,))
+
+    def poll(self) -> Set[str]:
+        """返回其他worker新写入的失效标签"""
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return set()
+        with self._lock:
+            self._mtime = mtime
+            rows = self._connect().execute(
+                "SELECT seq, tag FROM invalidations WHERE seq > ? ORDER BY seq",
+                (self._last_seq,)
+            ).fetchall()
+            if rows:
+                self._last_seq = rows[-1][0]
+        return {tag for _, tag in rows}
+
+
+class ResponseCache:
+    """已序列化响应的LRU缓存"""
+
+    def __init__(self, max_bytes: int, sync_path: Optional[str] = None, primary_window: float = 0):
+        self.max_bytes = max_bytes
+        self.primary_window = primary_window
+        self._entries: "OrderedDict[str, Tuple[bytes, Tuple[str, ...]]]" = OrderedDict()
+        self._tags: Dict[str, Set[str]] = {}
+        self._size = 0
+        self._generation = 0
+        # 标签最近一次失效的时间
+        self._invalidated_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._channel = InvalidationChannel(sync_path) if (sync_path and max_bytes > 0) else None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def generation(self) -> int:
+        """当前失效代数，查询数据库前获取，写入缓存时传回"""
+        return self._generation
+
+    def needs_primary(self, *tags: str) -> bool:
+        """标签刚失效过时返回True：副本可能尚未复制到这次写入，应从主库回源"""
+        if not self.enabled or self.primary_window <= 0:
+            return False
+        deadline = time.monotonic() - self.primary_window
+        with self._lock:
+            return any(self._invalidated_at.get(tag, deadline) > deadline for tag in tags)
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        self._sync()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, data: bytes, tags: Iterable[str], generation: int):
+        """写入缓存；如果查询期间发生过失效则放弃写入，避免缓存旧数据"""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        tags = tuple(tags)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(key)
+            self._entries[key] = (data, tags)
+            self._size += len(data)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *tags: str):
+        """使指定标签下的缓存失效，并通知其他worker"""
+        if not self.enabled:
+            return
+        self._drop(tags)
+        if self._channel is not None:
+            self._channel.publish(tags)
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _sync(self):
+        if self._channel is not None:
+            tags = self._channel.poll()
+            if tags:
+                self._drop(tags)
+
+    def _drop(self, tags: Iterable[str]):
+        now = time.monotonic()
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                self._invalidated_at[tag] = now
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+            if len(self._invalidated_at) > 4096:
+                deadline = now - self.primary_window
+                self._invalidated_at = {
+                    tag: at for tag, at in self._invalidated_at.items() if at > deadline
+                }
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        data, tags = entry
+        self._size -= len(data)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+record_cache = ResponseCache(RECORD_CACHE_MAX_BYTES, RECORD_CACHE_SYNC_PATH, RECORD_CACHE_PRIMARY_WINDOW)
@@ -1,14 +1,89 @@
 """
 数据库CRUD操作
 """
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, load_only, undefer
 from typing import Optional, List
-from . import models, schemas
+import hashlib
+import os
+from . import models, schemas, stats, retention
+from .cache import record_cache, record_tag, user_tag
+
+# 存储模式：full（每条记录保存完整数据）或 dedup（记录引用按四柱去重的命盘）
+STORAGE_MODE = os.getenv("BAZI_STORAGE_MODE", "full")
+
+
+def _chart_hash(bazi_data: dict) -> str:
+    """命盘内容哈希（规范化的四柱）"""
+    canonical = "|".join(bazi_data[key] for key in ('year_pillar', 'month_pillar', 'day_pillar', 'hour_pillar'))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _input_hash(bazi_request: schemas.BaziRequest) -> str:
+    """出生输入哈希（用户ID + 出生时间 + 时区 + 出生地）"""
+    canonical = "|".join(str(value) for value in (
+        bazi_request.user_id,
+        bazi_request.year,
+        bazi_request.month,
+        bazi_request.day,
+        bazi_request.hour,
+        bazi_request.minute,
+        bazi_request.timezone,
+    ))
+    if bazi_request.longitude is not None or bazi_request.birth_place:
+        # 真太阳时会改变命盘，出生地也属于出生输入
+        canonical += f"|{bazi_request.longitude}|{bazi_request.birth_place}"
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_or_create_chart(db: Session, bazi_data: dict) -> models.BaziChart:
+    """按四柱哈希获取命盘，不存在时创建（命盘不可变，单独提交）"""
+    chart_hash = _chart_hash(bazi_data)
+    chart = db.query(models.BaziChart).filter(models.BaziChart.chart_hash == chart_hash).first()
+    if chart:
+        return chart
+    
+    shared_data = {
+        key: value for key, value in bazi_data.items()
+        if key not in ('birth_time', 'timezone', 'longitude', 'true_solar_time')
+    }
+    chart = models.BaziChart(
+        chart_hash=chart_hash,
+        year_pillar=bazi_data['year_pillar'],
+        month_pillar=bazi_data['month_pillar'],
+        day_pillar=bazi_data['day_pillar'],
+        hour_pillar=bazi_data['hour_pillar'],
+        rigan=bazi_data['rigan'],
+        rigan_wuxing=bazi_data['rigan_wuxing'],
+        wuxing_analysis=bazi_data['wuxing_analysis'],
+        interpretation=bazi_data['interpretation']['full_text'],
+        full_data=shared_data
+    )
+    db.add(chart)
+    try:
+        db.commit()
+    except IntegrityError:
+        # 并发写入了相同命盘
+        db.rollback()
+        chart = db.query(models.BaziChart).filter(models.BaziChart.chart_hash == chart_hash).one()
+    return chart
+
+
+def _find_by_input(db: Session, input_hash: str) -> Optional[models.BaziRecord]:
+    """按输入哈希查找已有记录（含已归档的记录）"""
+    record = db.query(models.BaziRecord).filter(models.BaziRecord.input_hash == input_hash).first()
+    if record is None:
+        record = retention.find_archived_by_input(input_hash)
+    return record
 
 
 def create_bazi_record(db: Session, bazi_request: schemas.BaziRequest, bazi_data: dict) -> models.BaziRecord:
-    """创建八字记录"""
-    db_record = models.BaziRecord(
+    """
+    创建八字记录
+    
+    去重模式下记录只引用命盘；同一用户重复提交相同出生信息时返回已有记录
+    """
+    record_fields = dict(
         user_id=bazi_request.user_id,
         birth_year=bazi_request.year,
         birth_month=bazi_request.month,
@@ -16,40 +91,109 @@ def create_bazi_record(db: Session, bazi_request: schemas.BaziRequest, bazi_data
         birth_hour=bazi_request.hour,
         birth_minute=bazi_request.minute,
         timezone=bazi_request.timezone,
+        longitude=bazi_data.get('longitude'),
+        birth_place=bazi_request.birth_place,
         year_pillar=bazi_data['year_pillar'],
         month_pillar=bazi_data['month_pillar'],
         day_pillar=bazi_data['day_pillar'],
         hour_pillar=bazi_data['hour_pillar'],
         rigan=bazi_data['rigan'],
         rigan_wuxing=bazi_data['rigan_wuxing'],
-        wuxing_analysis=bazi_data['wuxing_analysis'],
-        interpretation=bazi_data['interpretation']['full_text'],
-        full_data=bazi_data
     )
     
+    if STORAGE_MODE == "dedup":
+        input_hash = None
+        if bazi_request.user_id:
+            input_hash = _input_hash(bazi_request)
+            existing = _find_by_input(db, input_hash)
+            if existing:
+                return existing
+        chart = get_or_create_chart(db, bazi_data)
+        db_record = models.BaziRecord(**record_fields, chart_id=chart.id, input_hash=input_hash)
+    else:
+        db_record = models.BaziRecord(
+            **record_fields,
+            wuxing_analysis=bazi_data['wuxing_analysis'],
+            interpretation=bazi_data['interpretation']['full_text'],
+            full_data=bazi_data
+        )
+    
     db.add(db_record)
+    try:
+        db.flush()
+    except IntegrityError:
+        if db_record.input_hash is None:
+            raise
+        # 并发的重复提交，返回先写入的记录
+        db.rollback()
+        existing = _find_by_input(db, db_record.input_hash)
+        if existing is None:
+            # 不是 input_hash 冲突
+            raise
+        return existing
+    # 统计计数与记录在同一事务中提交
+    stats.apply_record(db, db_record, 1, bazi_data['wuxing_analysis'])
     db.commit()
     db.refresh(db_record)
+    if db_record.user_id:
+        record_cache.invalidate(user_tag(db_record.user_id))
     return db_record
 
 
-def get_bazi_record(db: Session, record_id: int) -> Optional[models.BaziRecord]:
-    """获取单个八字记录"""
-    return db.query(models.BaziRecord).filter(models.BaziRecord.id == record_id).first()
+def _record_query(db: Session, fields: Optional[List[str]] = None):
+    """
+    构建记录查询，只加载需要的列
+    
+    fields为None时加载响应所需的全部列（full_data仍延迟加载）
+    """
+    shared = [
+        name for name in (fields or ('wuxing_analysis', 'interpretation'))
+        if name in models.BaziChart.SHARED_FIELDS
+    ]
+    if fields is None:
+        options = [undefer(getattr(models.BaziRecord, name)) for name in shared]
+    else:
+        names = set(fields) | ({'chart_id'} if shared else set())
+        options = [load_only(*[getattr(models.BaziRecord, name) for name in names])]
+    if shared:
+        # 去重存储的记录从命盘取大字段
+        options.append(
+            joinedload(models.BaziRecord.chart).load_only(*[getattr(models.BaziChart, name) for name in shared])
+        )
+    return db.query(models.BaziRecord).options(*options)
+
 
+def get_bazi_record(db: Session, record_id: int, fields: Optional[List[str]] = None) -> Optional[models.BaziRecord]:
+    """获取单个八字记录（热表中不存在时查找归档）"""
+    record = _record_query(db, fields).filter(models.BaziRecord.id == record_id).first()
+    if record is None:
+        record = retention.get_archived_record(record_id)
+    return record
 
-def get_bazi_records_by_user(db: Session, user_id: str, skip: int = 0, limit: int = 10) -> List[models.BaziRecord]:
+
+def get_bazi_records_by_user(
+    db: Session,
+    user_id: str,
+    skip: int = 0,
+    limit: int = 10,
+    fields: Optional[List[str]] = None
+) -> List[models.BaziRecord]:
     """获取用户的八字记录列表"""
-    return db.query(models.BaziRecord).filter(
+    return _record_query(db, fields).filter(
         models.BaziRecord.user_id == user_id
     ).order_by(
         models.BaziRecord.created_at.desc()
     ).offset(skip).limit(limit).all()
 
 
-def get_all_records(db: Session, skip: int = 0, limit: int = 100) -> List[models.BaziRecord]:
+def get_all_records(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    fields: Optional[List[str]] = None
+) -> List[models.BaziRecord]:
     """获取所有八字记录"""
-    return db.query(models.BaziRecord).order_by(
+    return _record_query(db, fields).order_by(
         models.BaziRecord.created_at.desc()
     ).offset(skip).limit(limit).all()
 
@@ -58,8 +202,28 @@ def delete_bazi_record(db: Session, record_id: int) -> bool:
     """删除八字记录"""
     record = db.query(models.BaziRecord).filter(models.BaziRecord.id == record_id).first()
     if record:
+        tags = [record_tag(record.id)]
+        if record.user_id:
+            tags.append(user_tag(record.user_id))
+        stats.apply_record(db, record, -1)
         db.delete(record)
         db.commit()
+        record_cache.invalidate(*tags)
+        return True
+    
+    # 已归档的记录：在同一事务中扣减统计，只有本次成功标记删除时才提交，
+    # 并发删除同一条归档记录时只扣减一次
+    record = retention.get_archived_record(record_id)
+    if record:
+        stats.apply_record(db, record, -1)
+        if not retention.archive_store.mark_deleted(record_id):
+            db.rollback()
+            return False
+        db.commit()
+        tags = [record_tag(record.id)]
+        if record.user_id:
+            tags.append(user_tag(record.user_id))
+        record_cache.invalidate(*tags)
         return True
     return False
 
@@ -0,0 +1,324 @@
+"""
+压力测试工具
+按目标速率（开环）发送混合请求，统计吞吐、延迟分位数、错误率与连接池占用
+
+进程内（ASGI，SQLite）：python -m app.loadtest --sqlite ./loadtest.db --rate 200 --duration 30
+压测已启动的服务：     python -m app.loadtest --url http://127.0.0.1:8000 --rate 500 --workers 4
+"""
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+
+# 请求类型权重
+MIXES: Dict[str, Dict[str, int]] = {
+    "default": {"calculate": 20, "calculate_nosave": 20, "record": 35, "user": 20, "timezones": 5},
+    "read-heavy": {"calculate": 5, "calculate_nosave": 10, "record": 55, "user": 25, "timezones": 5},
+    "write-heavy": {"calculate": 60, "calculate_nosave": 10, "record": 15, "user": 10, "timezones": 5},
+    "preview": {"calculate_nosave": 90, "timezones": 10},
+}
+
+TIMEZONES = ["Asia/Shanghai", "Asia/Urumqi", "Asia/Hong_Kong", "Asia/Tokyo", "America/New_York"]
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    """解析请求类型权重：预设名称，或 calculate=40,record=60 形式"""
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"未知请求类型: {name}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """最近秩百分位数：第 ceil(pct/100 × n) 个值"""
+    if not sorted_values:
+        return 0.0
+    # 先舍入，避免浮点误差（如 0.07 × 100 = 7.000000000000001）多进一位
+    rank = math.ceil(round(pct / 100 * len(sorted_values), 9)) - 1
+    rank = max(0, min(len(sorted_values) - 1, rank))
+    return sorted_values[rank]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    values = sorted(latencies)
+    return {
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round((values[-1] if values else 0) * 1000, 2),
+    }
+
+
+@dataclass
+class OperationStats:
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    status_codes: Dict[int, int] = field(default_factory=dict)
+
+
+@dataclass
+class Window:
+    """一个采样区间内的结果"""
+    completed: int = 0
+    errors: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+
+class Workload:
+    """生成各类请求，记录已创建的记录ID供查询使用"""
+
+    def __init__(self, users: int, seed: int):
+        self.random = random.Random(seed)
+        self.users = [f"loadtest-{index}" for index in range(users)]
+        self.record_ids: List[int] = []
+
+    def birth(self) -> Dict:
+        return {
+            "year": self.random.randint(1950, 2010),
+            "month": self.random.randint(1, 12),
+            "day": self.random.randint(1, 28),
+            "hour": self.random.randint(0, 23),
+            "minute": self.random.randint(0, 59),
+            "timezone": self.random.choice(TIMEZONES),
+            "user_id": self.random.choice(self.users),
+        }
+
+    def calculate(self, client):
+        return client.post("/api/v1/bazi/calculate", json=self.birth())
+
+    def calculate_nosave(self, client):
+        return client.post("/api/v1/bazi/calculate", params={"save_to_db": "false"}, json=self.birth())
+
+    def record(self, client):
+        record_id = self.random.choice(self.record_ids) if self.record_ids else 1
+        return client.get(f"/api/v1/bazi/record/{record_id}")
+
+    def user(self, client):
+        return client.get(f"/api/v1/bazi/user/{self.random.choice(self.users)}")
+
+    def timezones(self, client):
+        return client.get("/api/v1/timezones")
+
+
+OPERATIONS: Dict[str, Callable] = {
+    "calculate": Workload.calculate,
+    "calculate_nosave": Workload.calculate_nosave,
+    "record": Workload.record,
+    "user": Workload.user,
+    "timezones": Workload.timezones,
+}
+
+
+class LoadTest:
+    """开环压测：按计划时间发送请求，延迟从计划发送时间算起（避免协同遗漏）"""
+
+    def __init__(self, client, mix: Dict[str, int], rate: float, duration: float,
+                 interval: float, max_inflight: int, workload: Workload,
+                 pool_stats: Callable):
+        self.client = client
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.rate = rate
+        self.duration = duration
+        self.interval = interval
+        self.max_inflight = max_inflight
+        self.workload = workload
+        self.pool_stats = pool_stats
+        self.operations = {name: OperationStats() for name in self.names}
+        self.windows: List[Window] = []
+        self.timeline: List[Dict] = []
+        self.dropped = 0
+        self.inflight = 0
+
+    async def _send(self, name: str, scheduled: float):
+        self.inflight += 1
+        stats = self.operations[name]
+        try:
+            response = await OPERATIONS[name](self.workload, self.client)
+            ok = response.status_code < 400
+            stats.status_codes[response.status_code] = stats.status_codes.get(response.status_code, 0) + 1
+            if ok and name == "calculate":
+                record_id = response.json().get("id")
+                if record_id:
+                    self.workload.record_ids.append(record_id)
+        except Exception:
+            ok = False
+            stats.status_codes[0] = stats.status_codes.get(0, 0) + 1
+        finally:
+            self.inflight -= 1
+        latency = time.perf_counter() - scheduled
+        window = self.windows[-1]
+        stats.latencies.append(latency)
+        window.completed += 1
+        window.latencies.append(latency)
+        if not ok:
+            stats.errors += 1
+            window.errors += 1
+
+    async def _sample(self, start: float):
+        while True:
+            await asyncio.sleep(self.interval)
+            window = self.windows[-1]
+            self.windows.append(Window())
+            pool = await self.pool_stats()
+            self.timeline.append({
+                "t": round(time.perf_counter() - start, 1),
+                "rps": round(window.completed / self.interval, 1),
+                "errors": window.errors,
+                "inflight": self.inflight,
+                **summarize(window.latencies),
+                "pool": pool,
+            })
+
+    async def run(self) -> float:
+        self.windows.append(Window())
+        start = time.perf_counter()
+        sampler = asyncio.create_task(self._sample(start))
+        tasks = set()
+        total = int(self.rate * self.duration)
+        for index in range(total):
+            scheduled = start + index / self.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.inflight >= self.max_inflight:
+                # 客户端已饱和，记为丢弃而不是延后发送
+                self.dropped += 1
+                continue
+            name = self.workload.random.choices(self.names, self.weights)[0]
+            task = asyncio.create_task(self._send(name, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+        return elapsed
+
+    def report(self, elapsed: float, cpu_seconds: Optional[float], workers: int) -> Dict:
+        completed = sum(len(stats.latencies) for stats in self.operations.values())
+        errors = sum(stats.errors for stats in self.operations.values())
+        all_latencies = [latency for stats in self.operations.values() for latency in stats.latencies]
+        throughput = completed / elapsed if elapsed else 0.0
+        report = {
+            "target_rps": self.rate,
+            "elapsed_s": round(elapsed, 2),
+            "completed": completed,
+            "dropped": self.dropped,
+            "throughput_rps": round(throughput, 1),
+            "error_rate": round(errors / completed, 4) if completed else 0.0,
+            **summarize(all_latencies),
+            "operations": {
+                name: {
+                    "count": len(stats.latencies),
+                    "error_rate": round(stats.errors / len(stats.latencies), 4) if stats.latencies else 0.0,
+                    "status_codes": stats.status_codes,
+                    **summarize(stats.latencies),
+                }
+                for name, stats in self.operations.items()
+            },
+            "timeline": self.timeline,
+        }
+        if cpu_seconds:
+            # 进程内压测：服务端与客户端共用一个核，按实际CPU时间折算
+            report["cpu_seconds"] = round(cpu_seconds, 2)
+            report["rps_per_core"] = round(completed / cpu_seconds, 1)
+        else:
+            report["rps_per_core"] = round(throughput / workers, 1)
+        return report
+
+
+def print_report(report: Dict):
+    print(f"\n目标速率 {report['target_rps']} rps，实际吞吐 {report['throughput_rps']} rps，"
+          f"完成 {report['completed']}，丢弃 {report['dropped']}，错误率 {report['error_rate']:.2%}")
+    print(f"延迟 p50={report['p50_ms']}ms p95={report['p95_ms']}ms p99={report['p99_ms']}ms max={report['max_ms']}ms")
+    print(f"每核吞吐 {report['rps_per_core']} rps" + (
+        f"（CPU时间 {report['cpu_seconds']}s）" if "cpu_seconds" in report else ""))
+    print(f"\n{'请求类型':<18}{'数量':>8}{'错误率':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, stats in report["operations"].items():
+        print(f"{name:<18}{stats['count']:>8}{stats['error_rate']:>9.2%}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    print(f"\n{'时间':>6}{'rps':>8}{'错误':>6}{'在途':>6}{'p99':>10}  连接池(主库 checkedout/overflow)")
+    for point in report["timeline"]:
+        primary = (point["pool"] or {}).get("primary", {})
+        print(f"{point['t']:>6}{point['rps']:>8}{point['errors']:>6}{point['inflight']:>6}{point['p99_ms']:>10}"
+              f"  {primary.get('checkedout', '-')}/{primary.get('overflow', '-')}")
+
+
+async def main(args) -> Dict:
+    import httpx
+
+    workload = Workload(args.users, args.seed)
+    cpu_start = None
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+
+        async def pool_stats():
+            try:
+                return (await client.get("/api/v1/db/pool")).json()
+            except Exception:
+                return None
+    else:
+        if args.sqlite:
+            os.environ["DATABASE_URL"] = f"sqlite:///{args.sqlite}"
+        from .main import app
+        from .database import get_pool_stats
+
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=args.timeout
+        )
+
+        async def pool_stats():
+            return get_pool_stats()
+
+    async with client:
+        # 预先写入一批记录，供查询类请求使用
+        for _ in range(args.seed_records):
+            response = await workload.calculate(client)
+            if response.status_code < 400 and response.json().get("id"):
+                workload.record_ids.append(response.json()["id"])
+
+        test = LoadTest(client, args.mix, args.rate, args.duration, args.interval,
+                        args.max_inflight, workload, pool_stats)
+        if not args.url:
+            cpu_start = time.process_time()
+        elapsed = await test.run()
+        cpu_seconds = time.process_time() - cpu_start if cpu_start is not None else None
+    return test.report(elapsed, cpu_seconds, args.workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="八字API压力测试")
+    parser.add_argument("--url", help="被测服务地址；不指定时在进程内通过ASGI调用")
+    parser.add_argument("--sqlite", help="进程内模式使用的SQLite文件路径")
+    parser.add_argument("--mix", type=parse_mix, default=MIXES["default"],
+                        help=f"请求混合：{'/'.join(MIXES)} 或 calculate=40,record=60")
+    parser.add_argument("--rate", type=float, default=100, help="目标请求速率（rps）")
+    parser.add_argument("--duration", type=float, default=30, help="持续时间（秒）")
+    parser.add_argument("--interval", type=float, default=1, help="采样间隔（秒）")
+    parser.add_argument("--max-inflight", type=int, default=1000, help="客户端最大在途请求数")
+    parser.add_argument("--timeout", type=float, default=30, help="单个请求超时（秒）")
+    parser.add_argument("--users", type=int, default=100, help="模拟用户数")
+    parser.add_argument("--seed-records", type=int, default=20, help="压测前预写入的记录数")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    parser.add_argument("--workers", type=int, default=1, help="被测服务的worker数（用于折算每核吞吐）")
+    parser.add_argument("--json", help="将完整报告写入JSON文件")
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2, default=str)
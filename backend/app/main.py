@@ -2,15 +2,22 @@
 FastAPI主应用
 八字计算API服务
 """
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
+import asyncio
+import json
 import os
-from datetime import datetime
+import threading
+from datetime import date, datetime
 
-from . import models, schemas, crud
-from .database import engine, get_db, init_db
+from . import models, schemas, crud, stats, admission, profiler, bundle
+from .database import engine, get_db, get_read_db, get_pool_stats, init_db, read_session
+from .cache import record_cache, record_tag, user_tag
 from .bazi_calculator import calculate_bazi_from_input
 
 # 创建数据库表
@@ -39,6 +46,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 按请求采样分析（未启用时几乎无开销）
+app.add_middleware(profiler.ProfilerMiddleware)
+
+
+def _render(content) -> bytes:
+    """序列化为与JSONResponse一致的JSON字节"""
+    return json.dumps(
+        jsonable_encoder(content),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+FIELDS_QUERY = Query(
+    None,
+    description="返回字段（逗号分隔），如 id,year_pillar,month_pillar,day_pillar,hour_pillar,created_at；默认返回全部字段"
+)
+
+
+def _parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """解析 fields 参数，未知字段返回400"""
+    try:
+        return schemas.parse_record_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _fields_key(key: str, fields: Optional[List[str]]) -> str:
+    """缓存键附加字段列表"""
+    return key if fields is None else f"{key}?fields={','.join(fields)}"
+
+
+def _record_payload(record: models.BaziRecord, fields: Optional[List[str]]):
+    """记录转为响应内容：全部字段时按响应模型校验，否则只取所选字段"""
+    if fields is None:
+        return schemas.BaziRecordResponse.model_validate(
+            {name: record.resolve(name) for name in schemas.RECORD_FIELDS}
+        )
+    return {name: record.resolve(name) for name in fields}
+
 
 @app.on_event("startup")
 async def startup_event():
@@ -47,6 +96,8 @@ async def startup_event():
     print("📚 API文档地址: http://localhost:8000/docs")
     init_db()
     print("✅ 数据库初始化完成")
+    # 预先构建离线数据包，避免首个请求等待
+    bundle.get_bundle()
 
 
 @app.get("/", tags=["根路径"])
@@ -71,11 +122,31 @@ async def health_check():
     )
 
 
+@app.get("/api/v1/db/pool", tags=["健康检查"])
+async def get_db_pool_stats():
+    """
+    数据库连接池状态
+    
+    **返回：**
+    - 主库与各只读副本的连接池使用情况
+    - 记录缓存命中情况
+    - 准入控制队列与拒绝计数
+    """
+    return {
+        **get_pool_stats(),
+        "record_cache": record_cache.stats(),
+        "admission": admission.get_admission_stats()
+    }
+
+
 @app.post("/api/v1/bazi/calculate", response_model=schemas.BaziResponse, tags=["八字计算"])
 async def calculate_bazi(
     request: schemas.BaziRequest,
+    response: Response,
     db: Session = Depends(get_db),
-    save_to_db: bool = True
+    save_to_db: bool = True,
+    _rate_limited: None = Depends(admission.rate_limit_by_user),
+    _admitted: None = Depends(admission.admit("calculate"))
 ):
     """
     计算八字四柱和命理解读
@@ -88,6 +159,8 @@ async def calculate_bazi(
     - minute: 出生分钟 (0-59)，默认0
     - timezone: 时区，默认 Asia/Shanghai
     - user_id: 用户ID（可选）
+    - longitude: 出生地经度（可选），提供后日柱、时柱按真太阳时计算
+    - birth_place: 出生地（可选），未提供经度时按城市查经度
     
     **返回：**
     - 四柱（年月日时）
@@ -96,6 +169,11 @@ async def calculate_bazi(
     - 性格特征
     - 喜用神建议
     - 运势建议
+    
+    **过载保护：**
+    - 在途请求与排队已满时返回503（带Retry-After）
+    - 同一用户请求过于频繁时返回429（带Retry-After）
+    - 数据库写入排队过长时跳过保存，id为空，响应头带 X-Bazi-Degraded
     """
     try:
         # 计算八字
@@ -105,13 +183,19 @@ async def calculate_bazi(
             day=request.day,
             hour=request.hour,
             minute=request.minute,
-            timezone_str=request.timezone
+            timezone_str=request.timezone,
+            longitude=request.longitude,
+            birth_place=request.birth_place
         )
         
-        # 保存到数据库
+        # 保存到数据库（在线程池中执行，避免阻塞事件循环）
         record_id = None
+        if save_to_db and admission.should_degrade():
+            save_to_db = False
+            response.headers["X-Bazi-Degraded"] = "save-skipped"
         if save_to_db:
-            db_record = crud.create_bazi_record(db, request, bazi_data)
+            async with admission.limiters["db_write"].slot():
+                db_record = await run_in_threadpool(crud.create_bazi_record, db, request, bazi_data)
             record_id = db_record.id
         
         # 构建响应
@@ -122,6 +206,8 @@ async def calculate_bazi(
         
         return schemas.BaziResponse(**response_data)
         
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -135,23 +221,32 @@ async def calculate_bazi(
 
 
 @app.get("/api/v1/bazi/record/{record_id}", response_model=schemas.BaziRecordResponse, tags=["八字查询"])
-async def get_bazi_record(record_id: int, db: Session = Depends(get_db)):
+async def get_bazi_record(record_id: int, fields: Optional[str] = FIELDS_QUERY):
     """
     根据ID查询八字记录
     
     **参数：**
     - record_id: 记录ID
+    - fields: 返回字段（可选，逗号分隔）
     
     **返回：**
     - 八字记录详情
     """
-    record = crud.get_bazi_record(db, record_id)
-    if not record:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"未找到ID为{record_id}的记录"
-        )
-    return record
+    field_list = _parse_fields(fields)
+    cache_key = _fields_key(record_tag(record_id), field_list)
+    body = record_cache.get(cache_key)
+    if body is None:
+        generation = record_cache.generation()
+        with read_session(primary=record_cache.needs_primary(record_tag(record_id))) as db:
+            record = crud.get_bazi_record(db, record_id, field_list)
+            if not record:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"未找到ID为{record_id}的记录"
+                )
+            body = _render(_record_payload(record, field_list))
+        record_cache.set(cache_key, body, [record_tag(record_id)], generation)
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/api/v1/bazi/user/{user_id}", response_model=List[schemas.BaziRecordResponse], tags=["八字查询"])
@@ -159,7 +254,7 @@ async def get_user_bazi_records(
     user_id: str,
     skip: int = 0,
     limit: int = 10,
-    db: Session = Depends(get_db)
+    fields: Optional[str] = FIELDS_QUERY
 ):
     """
     查询用户的八字记录列表
@@ -168,19 +263,32 @@ async def get_user_bazi_records(
     - user_id: 用户ID
     - skip: 跳过记录数（分页）
     - limit: 返回记录数（分页）
+    - fields: 返回字段（可选，逗号分隔）
     
     **返回：**
     - 八字记录列表
     """
-    records = crud.get_bazi_records_by_user(db, user_id, skip, limit)
-    return records
+    field_list = _parse_fields(fields)
+    # 只缓存第一页
+    cache_key = _fields_key(f"{user_tag(user_id)}:{limit}", field_list) if skip == 0 else None
+    body = record_cache.get(cache_key) if cache_key else None
+    if body is None:
+        generation = record_cache.generation()
+        with read_session(primary=record_cache.needs_primary(user_tag(user_id))) as db:
+            records = crud.get_bazi_records_by_user(db, user_id, skip, limit, field_list)
+            body = _render([_record_payload(record, field_list) for record in records])
+        if cache_key:
+            tags = [user_tag(user_id)] + [record_tag(record.id) for record in records]
+            record_cache.set(cache_key, body, tags, generation)
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/api/v1/bazi/records", response_model=List[schemas.BaziRecordResponse], tags=["八字查询"])
 async def get_all_bazi_records(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    fields: Optional[str] = FIELDS_QUERY,
+    db: Session = Depends(get_read_db)
 ):
     """
     查询所有八字记录
@@ -188,12 +296,17 @@ async def get_all_bazi_records(
     **参数：**
     - skip: 跳过记录数（分页）
     - limit: 返回记录数（分页）
+    - fields: 返回字段（可选，逗号分隔）
     
     **返回：**
     - 八字记录列表
     """
-    records = crud.get_all_records(db, skip, limit)
-    return records
+    field_list = _parse_fields(fields)
+    records = crud.get_all_records(db, skip, limit, field_list)
+    return Response(
+        content=_render([_record_payload(record, field_list) for record in records]),
+        media_type="application/json"
+    )
 
 
 @app.delete("/api/v1/bazi/record/{record_id}", tags=["八字管理"])
@@ -216,6 +329,32 @@ async def delete_bazi_record(record_id: int, db: Session = Depends(get_db)):
     return {"message": f"记录{record_id}已成功删除"}
 
 
+@app.get("/api/v1/stats", response_model=schemas.StatsResponse, tags=["统计"])
+async def get_stats(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    user_id: Optional[str] = None,
+    bucket: str = Query("day", pattern="^(day|month)$"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    查询统计数据（基于增量维护的计数表，不扫描记录表）
+    
+    **参数：**
+    - start: 开始日期（可选，YYYY-MM-DD）
+    - end: 结束日期（可选，YYYY-MM-DD）
+    - user_id: 用户ID（可选，默认统计全部用户）
+    - bucket: 记录数分桶粒度，day 或 month
+    
+    **返回：**
+    - 每日/每月记录数
+    - 日主分布
+    - 最旺、最弱五行分布
+    - 各五行个数直方图
+    """
+    return stats.query_stats(db, start, end, user_id, bucket)
+
+
 @app.get("/api/v1/timezones", tags=["工具"])
 async def get_timezones():
     """
@@ -256,6 +395,168 @@ async def get_timezones():
     }
 
 
+# 按版本号的数据包内容不会变化，可永久缓存；manifest 需要及时发现新版本
+BUNDLE_IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+BUNDLE_MANIFEST_CACHE = "public, max-age=300"
+
+
+@app.get("/api/v1/bundle", tags=["离线数据"])
+async def get_bundle_manifest():
+    """
+    获取离线数据包的当前版本
+    
+    **返回：**
+    - version: 数据包版本（内容哈希）
+    - data / vectors: 数据包与一致性测试向量的地址、大小与SHA-256
+    """
+    return Response(
+        content=_render(bundle.get_bundle().manifest()),
+        media_type="application/json",
+        headers={"Cache-Control": BUNDLE_MANIFEST_CACHE}
+    )
+
+
+def _bundle_response(version: str, name: str, accept_encoding: Optional[str], if_none_match: Optional[str]) -> Response:
+    """按版本返回数据包文件：支持预压缩gzip与ETag协商"""
+    current = bundle.get_bundle()
+    if version != current.version:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"数据包版本{version}不存在")
+    bundle_file = current.file(name)
+    headers = {"Cache-Control": BUNDLE_IMMUTABLE_CACHE, "ETag": bundle_file.etag, "Vary": "Accept-Encoding"}
+    if if_none_match and bundle_file.etag in if_none_match:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if accept_encoding and "gzip" in accept_encoding:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=bundle_file.gzipped, media_type="application/json", headers=headers)
+    return Response(content=bundle_file.content, media_type="application/json", headers=headers)
+
+
+@app.get("/api/v1/bundle/{version}.json", tags=["离线数据"])
+async def get_bundle_data(
+    version: str,
+    accept_encoding: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    下载离线数据包（六十甲子、节气边界、干支五行、均时差、解读文案）
+    
+    地址带版本号，内容不变，可永久缓存
+    """
+    return _bundle_response(version, "data", accept_encoding, if_none_match)
+
+
+@app.get("/api/v1/bundle/{version}/vectors.json", tags=["离线数据"])
+async def get_bundle_vectors(
+    version: str,
+    accept_encoding: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    下载一致性测试向量（由服务端计算器生成的输入与期望结果）
+    
+    客户端实现本地排盘后应逐条比对，全部一致才启用本地计算
+    """
+    return _bundle_response(version, "vectors", accept_encoding, if_none_match)
+
+
+@app.post("/api/v1/admin/profile", tags=["管理"], dependencies=[Depends(profiler.require_admin)])
+async def profile_worker(
+    duration: float = Query(10, gt=0, le=profiler.PROFILE_MAX_DURATION, description="采样时长（秒）"),
+    rate: int = Query(100, gt=0, le=profiler.PROFILE_MAX_RATE, description="每秒采样次数"),
+    format: str = Query("collapsed", pattern="^(collapsed|json)$", description="输出格式")
+):
+    """
+    对当前worker进行限时采样分析（需要 X-Admin-Token）
+    
+    **参数：**
+    - duration: 采样时长（秒）
+    - rate: 每秒采样次数
+    - format: collapsed（折叠栈文本，可生成火焰图）或 json
+    
+    **返回：**
+    - 事件循环与线程池中各线程的调用栈采样结果
+    """
+    if not profiler.state.acquire():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="已有分析正在进行")
+    try:
+        sampler = profiler.SamplingProfiler(rate, loop_thread=threading.get_ident())
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            sampler.stop()
+    finally:
+        profiler.state.release()
+    if format == "json":
+        return {**sampler.summary(), "collapsed": dict(sampler.stacks.most_common())}
+    return PlainTextResponse(sampler.collapsed())
+
+
+@app.post("/api/v1/admin/profile/requests", tags=["管理"], dependencies=[Depends(profiler.require_admin)])
+async def profile_next_requests(
+    route: str = Query(..., description="路由路径前缀，如 /api/v1/bazi/calculate"),
+    count: int = Query(100, gt=0, le=100000, description="分析的请求数"),
+    rate: int = Query(200, gt=0, le=profiler.PROFILE_MAX_RATE, description="每秒采样次数"),
+    duration: float = Query(
+        profiler.PROFILE_MAX_DURATION, gt=0, le=profiler.PROFILE_MAX_DURATION,
+        description="最长分析时间（秒），不足N个请求时到时结束"
+    )
+):
+    """
+    分析接下来N个匹配路由的请求（需要 X-Admin-Token）
+    
+    只在匹配的请求在途期间采样；N个请求完成、超过 duration 或被取消后结束，
+    通过 GET 同一路径获取结果，DELETE 同一路径取消
+    """
+    if not profiler.state.acquire():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="已有分析正在进行")
+    try:
+        profiler.state.request_profile = profiler.RequestProfile(
+            route, count, rate, threading.get_ident(), duration
+        )
+    finally:
+        profiler.state.release()
+    return profiler.state.request_profile.status()
+
+
+@app.get("/api/v1/admin/profile/requests", tags=["管理"], dependencies=[Depends(profiler.require_admin)])
+async def get_request_profile(
+    format: str = Query("json", pattern="^(collapsed|json)$", description="输出格式")
+):
+    """
+    获取按请求分析的进度与结果（需要 X-Admin-Token）
+    
+    **返回：**
+    - 未完成时返回进度；完成后 format=collapsed 返回折叠栈文本
+    """
+    profile = profiler.state.request_profile
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="没有按请求分析的任务")
+    profile.check()
+    if format == "collapsed":
+        if not profile.done:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="分析尚未完成")
+        return PlainTextResponse(profile.collapsed())
+    result = profile.status()
+    if profile.done:
+        result["collapsed"] = dict(profile.stacks.most_common())
+    return result
+
+
+@app.delete("/api/v1/admin/profile/requests", tags=["管理"], dependencies=[Depends(profiler.require_admin)])
+async def cancel_request_profile():
+    """
+    取消按请求分析（需要 X-Admin-Token）
+    
+    立即停止采样，已采集的结果仍可通过 GET 获取
+    """
+    profile = profiler.state.request_profile
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="没有按请求分析的任务")
+    profile.cancel()
+    return profile.status()
+
+
 if __name__ == "__main__":
     import uvicorn
     
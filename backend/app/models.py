@@ -1,7 +1,8 @@
 """
 数据库模型
 """
-from sqlalchemy import Column, Integer, String, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, Float, String, Date, DateTime, Text, JSON, ForeignKey
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql import func
 from .database import Base
 
@@ -22,6 +23,8 @@ class BaziRecord(Base):
     birth_hour = Column(Integer, nullable=False, comment="出生小时")
     birth_minute = Column(Integer, nullable=False, default=0, comment="出生分钟")
     timezone = Column(String(50), nullable=False, default="Asia/Shanghai", comment="时区")
+    longitude = Column(Float, nullable=True, comment="出生地经度（真太阳时）")
+    birth_place = Column(String(50), nullable=True, comment="出生地")
     
     # 八字结果
     year_pillar = Column(String(10), nullable=False, comment="年柱")
@@ -33,19 +36,76 @@ class BaziRecord(Base):
     rigan = Column(String(5), nullable=False, comment="日主")
     rigan_wuxing = Column(String(5), nullable=False, comment="日主五行")
     
+    # 去重存储：引用命盘表，大字段不再逐行保存
+    chart_id = Column(Integer, ForeignKey("bazi_charts.id"), nullable=True, index=True, comment="命盘ID")
+    input_hash = Column(String(64), nullable=True, unique=True, comment="出生输入哈希（用于幂等写入）")
+    
+    # 大字段默认延迟加载，查询时按需取出
     # 五行分析（JSON格式）
-    wuxing_analysis = Column(JSON, nullable=True, comment="五行分析")
+    wuxing_analysis = deferred(Column(JSON, nullable=True, comment="五行分析"))
     
     # 命理解读
-    interpretation = Column(Text, nullable=True, comment="命理解读")
+    interpretation = deferred(Column(Text, nullable=True, comment="命理解读"))
     
     # 完整八字数据（JSON格式）
-    full_data = Column(JSON, nullable=True, comment="完整八字数据")
+    full_data = deferred(Column(JSON, nullable=True, comment="完整八字数据"))
     
     # 时间戳
     created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
     updated_at = Column(DateTime(timezone=True), onupdate=func.now(), comment="更新时间")
     
+    chart = relationship("BaziChart")
+    
+    def resolve(self, name: str):
+        """读取字段，去重存储的记录从命盘取大字段"""
+        value = getattr(self, name)
+        if value is None and name in BaziChart.SHARED_FIELDS and self.chart_id is not None:
+            value = getattr(self.chart, name)
+        return value
+    
     def __repr__(self):
         return f"<BaziRecord {self.year_pillar}{self.month_pillar}{self.day_pillar}{self.hour_pillar}>"
 
+
+
+class BaziChart(Base):
+    """命盘表（按四柱内容哈希去重，派生数据只保存一份）"""
+    __tablename__ = "bazi_charts"
+    
+    # 记录表可以从命盘读取的字段
+    SHARED_FIELDS = ("wuxing_analysis", "interpretation", "full_data")
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    chart_hash = Column(String(64), nullable=False, unique=True, comment="四柱内容哈希")
+    
+    # 八字结果
+    year_pillar = Column(String(10), nullable=False, comment="年柱")
+    month_pillar = Column(String(10), nullable=False, comment="月柱")
+    day_pillar = Column(String(10), nullable=False, comment="日柱")
+    hour_pillar = Column(String(10), nullable=False, comment="时柱")
+    rigan = Column(String(5), nullable=False, comment="日主")
+    rigan_wuxing = Column(String(5), nullable=False, comment="日主五行")
+    
+    # 派生数据
+    wuxing_analysis = deferred(Column(JSON, nullable=True, comment="五行分析"))
+    interpretation = deferred(Column(Text, nullable=True, comment="命理解读"))
+    full_data = deferred(Column(JSON, nullable=True, comment="八字数据（不含出生时间）"))
+    
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+    
+    def __repr__(self):
+        return f"<BaziChart {self.year_pillar}{self.month_pillar}{self.day_pillar}{self.hour_pillar}>"
+
+
+class BaziStat(Base):
+    """统计计数表（按日期、用户、维度累计，随记录增删增量更新）"""
+    __tablename__ = "bazi_stats"
+    
+    bucket = Column(Date, primary_key=True, comment="日期")
+    user_id = Column(String(100), primary_key=True, default="", comment="用户ID（空字符串表示全部用户）")
+    dimension = Column(String(20), primary_key=True, comment="统计维度")
+    value = Column(String(10), primary_key=True, default="", comment="维度取值")
+    count = Column(Integer, nullable=False, default=0, comment="计数")
+    
+    def __repr__(self):
+        return f"<BaziStat {self.bucket} {self.dimension}={self.value}: {self.count}>"
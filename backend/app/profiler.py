@@ -0,0 +1,270 @@
+"""
+采样分析器
+定时采集所有线程（事件循环与线程池）的Python调用栈，聚合为折叠栈格式，
+可直接用 flamegraph.pl / speedscope 生成火焰图；空闲时不启动采样线程
+"""
+from collections import Counter
+from typing import Callable, Dict, Optional
+import hmac
+import os
+import sys
+import threading
+import time
+
+from fastapi import Header, HTTPException, status
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# 单次分析的上限
+PROFILE_MAX_DURATION = float(os.getenv("PROFILE_MAX_DURATION", "60"))
+PROFILE_MAX_RATE = int(os.getenv("PROFILE_MAX_RATE", "1000"))
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """管理接口鉴权：未配置 ADMIN_TOKEN 时接口不可用"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="无权访问")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """后台线程按固定频率采样调用栈"""
+
+    def __init__(
+        self,
+        rate: int,
+        loop_thread: Optional[int] = None,
+        stacks: Optional[Counter] = None,
+        deadline: Optional[float] = None,
+        active: Optional[Callable[[], bool]] = None
+    ):
+        """
+        Args:
+            stacks: 累加到已有的计数
+            deadline: 到达该时刻（time.monotonic）后采样线程自行退出
+            active: 每个采样点调用，返回False时跳过本次采样
+        """
+        self.rate = rate
+        self.loop_thread = loop_thread
+        self.deadline = deadline
+        self.active = active
+        self.stacks: Counter = stacks if stacks is not None else Counter()
+        self.samples = 0
+        self.started_at = 0.0
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="bazi-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.elapsed = time.perf_counter() - self.started_at
+        return self.stacks
+
+    def _thread_name(self, ident: int, names: Dict[int, str]) -> str:
+        if ident == self.loop_thread:
+            return "event-loop"
+        return names.get(ident, f"thread-{ident}").replace(" ", "_")
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        own = threading.get_ident()
+        # 启动时立即采样一次，短于一个采样间隔的请求也能被采到
+        while True:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                break
+            if self.active is None or self.active():
+                self._sample(own)
+            if self._stop.wait(interval):
+                break
+
+    def _sample(self, own: int):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(self._thread_name(ident, names))
+            self.stacks[";".join(reversed(labels))] += 1
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        """折叠栈文本：每行为 "栈;帧 次数" """
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def summary(self) -> Dict:
+        return {
+            "rate": self.rate,
+            "samples": self.samples,
+            "elapsed": round(self.elapsed, 3),
+            "stacks": len(self.stacks),
+        }
+
+
+class RequestProfile:
+    """
+    分析接下来N个匹配路由的请求，超过时限或被取消后结束
+
+    第一个匹配请求到来时启动一个采样线程并保持到分析结束，只在有匹配请求在途时采样；
+    elapsed 为有请求在途的累计时长
+    """
+
+    def __init__(self, route: str, count: int, rate: int, loop_thread: int, duration: float = PROFILE_MAX_DURATION):
+        self.route = route.rstrip("/") or "/"
+        self.remaining = count
+        self.count = count
+        self.rate = rate
+        self.loop_thread = loop_thread
+        self.deadline = time.monotonic() + duration
+        self.inflight = 0
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self.profiler: Optional[SamplingProfiler] = None
+        self.done = False
+        self.cancelled = False
+        self._active_since = 0.0
+        self._lock = threading.Lock()
+
+    def matches(self, path: str) -> bool:
+        return path == self.route or path.startswith(self.route + "/")
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    def _active(self) -> bool:
+        return self.inflight > 0
+
+    def enter(self) -> bool:
+        """请求开始；返回该请求是否计入分析"""
+        with self._lock:
+            if self.done or self.remaining <= 0:
+                return False
+            if self.expired():
+                self._finish()
+                return False
+            self.remaining -= 1
+            self.inflight += 1
+            if self.inflight == 1:
+                self._active_since = time.perf_counter()
+            if self.profiler is None:
+                self.profiler = SamplingProfiler(
+                    self.rate, self.loop_thread, self.stacks, self.deadline, active=self._active
+                )
+                self.profiler.start()
+            return True
+
+    def exit(self):
+        with self._lock:
+            self.inflight -= 1
+            if self.inflight == 0 and not self.done:
+                self.elapsed += time.perf_counter() - self._active_since
+                if self.remaining <= 0 or self.expired():
+                    self._finish()
+
+    def check(self):
+        """超过时限时结束分析（采样线程到时限会自行退出，这里负责回收并标记结束）"""
+        with self._lock:
+            if not self.done and self.expired():
+                self._finish()
+
+    def cancel(self):
+        with self._lock:
+            if not self.done:
+                self.cancelled = True
+                self._finish()
+
+    def _finish(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.samples = self.profiler.samples
+            self.profiler = None
+        if self.inflight > 0:
+            # 取消或超时时仍有请求在途
+            self.elapsed += time.perf_counter() - self._active_since
+        self.done = True
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def status(self) -> Dict:
+        self.check()
+        result = {
+            "route": self.route,
+            "count": self.count,
+            "profiled": self.count - self.remaining,
+            "inflight": self.inflight,
+            "done": self.done,
+            "cancelled": self.cancelled,
+            "remaining_seconds": round(max(0.0, self.deadline - time.monotonic()), 1),
+        }
+        if self.done:
+            result.update({
+                "rate": self.rate,
+                "samples": self.samples,
+                "elapsed": round(self.elapsed, 3),
+                "stacks": len(self.stacks),
+            })
+        return result
+
+
+class ProfilerState:
+    """全局分析状态（同一时间只允许一次分析）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = False
+        self.request_profile: Optional[RequestProfile] = None
+
+    def acquire(self) -> bool:
+        """占用分析器；已有分析在进行时返回False"""
+        if self.request_profile is not None:
+            self.request_profile.check()
+        with self.lock:
+            active = self.request_profile is not None and not self.request_profile.done
+            if self.busy or active:
+                return False
+            self.busy = True
+            return True
+
+    def release(self):
+        with self.lock:
+            self.busy = False
+
+
+state = ProfilerState()
+
+
+class ProfilerMiddleware:
+    """ASGI中间件：未启用按请求分析时只做一次属性判断"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        profile = state.request_profile
+        if profile is None or profile.done or scope["type"] != "http" or not profile.matches(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        if not profile.enter():
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profile.exit()
@@ -0,0 +1,313 @@
+"""
+记录归档
+按 created_at 月份把旧记录分批移出 bazi_records，写入本地压缩的列式归档文件，
+并用SQLite索引记录每个ID所在的文件，查询单条记录时可透明读取
+
+运行一次：python -m app.retention
+持续运行：python -m app.retention --loop 3600
+"""
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session, joinedload, undefer
+
+from . import models
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+
+# 超过该天数的记录被归档（0表示不按时间归档）
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "365"))
+
+# 热表最多保留的记录数，超出部分从最旧的开始归档（0表示不限制）
+RETENTION_MAX_HOT_ROWS = int(os.getenv("RETENTION_MAX_HOT_ROWS", "0"))
+
+# 每批归档的记录数与批次间隔（秒），避免长事务影响在线写入
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_BATCH_SLEEP = float(os.getenv("RETENTION_BATCH_SLEEP", "0.5"))
+
+ARCHIVE_COLUMNS = [column.name for column in models.BaziRecord.__table__.columns]
+
+_DATETIME_COLUMNS = ("created_at", "updated_at")
+
+
+class ArchiveStore:
+    """归档文件与索引"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.sqlite3")
+        self._local = threading.local()
+
+    def _index(self, create: bool = False) -> Optional[sqlite3.Connection]:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        if not create and not os.path.exists(self.index_path):
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.index_path, timeout=10)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS archived ("
+            "id INTEGER PRIMARY KEY, month TEXT NOT NULL, segment TEXT NOT NULL, "
+            "position INTEGER NOT NULL, deleted INTEGER NOT NULL DEFAULT 0, input_hash TEXT)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(archived)")}
+        if "input_hash" not in columns:
+            self._add_input_hash(conn)
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_archived_input_hash ON archived (input_hash)")
+        conn.commit()
+        self._local.conn = conn
+        return conn
+
+    def _add_input_hash(self, conn: sqlite3.Connection):
+        """旧版索引补充 input_hash 列，并从归档文件回填"""
+        conn.execute("ALTER TABLE archived ADD COLUMN input_hash TEXT")
+        segments = [row[0] for row in conn.execute("SELECT DISTINCT segment FROM archived")]
+        for segment in segments:
+            payload = _load_segment(os.path.join(self.directory, segment))
+            hashes = payload["data"].get("input_hash")
+            if hashes:
+                conn.executemany(
+                    "UPDATE archived SET input_hash = ? WHERE segment = ? AND position = ?",
+                    [(value, segment, position) for position, value in enumerate(hashes) if value]
+                )
+
+    def write_segment(self, month: str, rows: List[Dict]):
+        """写入一个列式归档文件并登记索引"""
+        month_dir = os.path.join(self.directory, month)
+        os.makedirs(month_dir, exist_ok=True)
+        segment = f"{month}/segment-{rows[0]['id']:010d}-{rows[-1]['id']:010d}.json.gz"
+        payload = {
+            "version": 1,
+            "columns": ARCHIVE_COLUMNS,
+            "data": {name: [row[name] for row in rows] for name in ARCHIVE_COLUMNS},
+        }
+        path = os.path.join(self.directory, segment)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=9) as f:
+            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        conn = self._index(create=True)
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO archived (id, month, segment, position, deleted, input_hash) "
+                "VALUES (?, ?, ?, ?, 0, ?)",
+                [(row["id"], month, segment, position, row["input_hash"]) for position, row in enumerate(rows)]
+            )
+
+    def get(self, record_id: int) -> Optional[Dict]:
+        """读取归档记录，不存在或已删除时返回None"""
+        conn = self._index()
+        if conn is None:
+            return None
+        located = conn.execute(
+            "SELECT segment, position FROM archived WHERE id = ? AND deleted = 0", (record_id,)
+        ).fetchone()
+        if located is None:
+            return None
+        segment, position = located
+        return _segment_row(_load_segment(os.path.join(self.directory, segment)), position)
+
+    def find_by_input_hash(self, input_hash: str) -> Optional[int]:
+        """按输入哈希查找未删除的归档记录ID"""
+        conn = self._index()
+        if conn is None:
+            return None
+        located = conn.execute(
+            "SELECT id FROM archived WHERE input_hash = ? AND deleted = 0 ORDER BY id LIMIT 1", (input_hash,)
+        ).fetchone()
+        return located[0] if located else None
+
+    def iter_segments(self) -> Iterator[List[Dict]]:
+        """按文件依次返回全部未删除的归档记录"""
+        conn = self._index()
+        if conn is None:
+            return
+        segments = [row[0] for row in conn.execute("SELECT DISTINCT segment FROM archived ORDER BY segment")]
+        for segment in segments:
+            positions = [row[0] for row in conn.execute(
+                "SELECT position FROM archived WHERE segment = ? AND deleted = 0 ORDER BY position", (segment,)
+            )]
+            if positions:
+                payload = _load_segment(os.path.join(self.directory, segment))
+                yield [_segment_row(payload, position) for position in positions]
+
+    def mark_deleted(self, record_id: int) -> bool:
+        """标记删除；返回是否由本次调用标记（记录不存在或已删除时返回False）"""
+        conn = self._index()
+        if conn is None:
+            return False
+        with conn:
+            cursor = conn.execute("UPDATE archived SET deleted = 1 WHERE id = ? AND deleted = 0", (record_id,))
+        return cursor.rowcount > 0
+
+    def stats(self) -> Dict:
+        conn = self._index()
+        if conn is None:
+            return {"archived": 0, "months": {}}
+        months = dict(conn.execute(
+            "SELECT month, COUNT(*) FROM archived WHERE deleted = 0 GROUP BY month ORDER BY month"
+        ).fetchall())
+        return {"archived": sum(months.values()), "months": months}
+
+
+@lru_cache(maxsize=16)
+def _load_segment(path: str) -> Dict:
+    """读取并缓存归档文件（文件写入后不再修改）"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _segment_row(payload: Dict, position: int) -> Dict:
+    """
+    按归档文件自带的列清单取出一行
+
+    归档后新增的列取None，已不存在的列被忽略
+    """
+    data = payload["data"]
+    stored = set(payload["columns"])
+    row = {name: data[name][position] if name in stored else None for name in ARCHIVE_COLUMNS}
+    for name in _DATETIME_COLUMNS:
+        if row[name]:
+            row[name] = datetime.fromisoformat(row[name])
+    return row
+
+
+archive_store = ArchiveStore(ARCHIVE_DIR)
+
+
+def get_archived_record(record_id: int) -> Optional[models.BaziRecord]:
+    """从归档读取记录，返回未加入会话的BaziRecord对象"""
+    row = archive_store.get(record_id)
+    if row is None:
+        return None
+    # 归档时已展开命盘字段
+    row["chart_id"] = None
+    return models.BaziRecord(**row)
+
+
+def find_archived_by_input(input_hash: str) -> Optional[models.BaziRecord]:
+    """按输入哈希查找归档记录（保证归档后重复提交仍然幂等）"""
+    record_id = archive_store.find_by_input_hash(input_hash)
+    return get_archived_record(record_id) if record_id is not None else None
+
+
+def _serialize(record: models.BaziRecord) -> Dict:
+    row = {name: record.resolve(name) for name in ARCHIVE_COLUMNS}
+    for name in _DATETIME_COLUMNS:
+        if row[name] is not None:
+            row[name] = row[name].isoformat()
+    return row
+
+
+def archive_batch(db: Session, cutoff: Optional[datetime], limit: int) -> int:
+    """
+    归档一批记录：写入归档文件后从热表删除
+
+    Args:
+        cutoff: 早于该时间的记录会被归档；为None时只按 limit 归档最旧的记录
+        limit: 本批最多归档的记录数
+
+    Returns:
+        本批归档的记录数
+    """
+    # 锁住本批记录直到从热表删除，期间并发的删除请求会等待，随后按归档记录删除
+    query = db.query(models.BaziRecord.id)
+    if cutoff is not None:
+        query = query.filter(models.BaziRecord.created_at < cutoff)
+    ids = [record_id for (record_id,) in query.order_by(models.BaziRecord.id).limit(limit).with_for_update()]
+    if not ids:
+        db.rollback()
+        return 0
+    records = db.query(models.BaziRecord).options(
+        undefer(models.BaziRecord.wuxing_analysis),
+        undefer(models.BaziRecord.interpretation),
+        undefer(models.BaziRecord.full_data),
+        joinedload(models.BaziRecord.chart).undefer("*")
+    ).filter(models.BaziRecord.id.in_(ids)).order_by(models.BaziRecord.id).all()
+
+    by_month: Dict[str, List[Dict]] = {}
+    for record in records:
+        by_month.setdefault(record.created_at.strftime("%Y-%m"), []).append(_serialize(record))
+    for month, rows in by_month.items():
+        rows.sort(key=lambda row: row["id"])
+        archive_store.write_segment(month, rows)
+
+    # 归档文件已落盘，再从热表删除（统计计数保持不变，记录仍可查询；重建统计时会计入归档记录）
+    ids = [record.id for record in records]
+    present = {
+        record_id for (record_id,) in
+        db.query(models.BaziRecord.id).filter(models.BaziRecord.id.in_(ids))
+    }
+    db.query(models.BaziRecord).filter(models.BaziRecord.id.in_(present)).delete(synchronize_session=False)
+    db.commit()
+    db.expunge_all()
+    # 不支持行锁的数据库（SQLite）上，读取后被删除的记录已扣减过统计，不能从归档恢复
+    for record_id in set(ids) - present:
+        archive_store.mark_deleted(record_id)
+    return len(present)
+
+
+def run_retention(
+    db: Session,
+    max_age_days: int = RETENTION_MAX_AGE_DAYS,
+    max_hot_rows: int = RETENTION_MAX_HOT_ROWS,
+    batch_size: int = RETENTION_BATCH_SIZE,
+    batch_sleep: float = RETENTION_BATCH_SLEEP
+) -> int:
+    """按保留策略分批归档，返回归档的记录总数"""
+    total = 0
+
+    if max_age_days > 0:
+        cutoff = datetime.now() - timedelta(days=max_age_days)
+        while True:
+            archived = archive_batch(db, cutoff, batch_size)
+            total += archived
+            if archived < batch_size:
+                break
+            time.sleep(batch_sleep)
+
+    if max_hot_rows > 0:
+        excess = db.query(func.count(models.BaziRecord.id)).scalar() - max_hot_rows
+        while excess > 0:
+            archived = archive_batch(db, None, min(batch_size, excess))
+            if not archived:
+                break
+            total += archived
+            excess -= archived
+            if excess > 0:
+                time.sleep(batch_sleep)
+
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="归档 bazi_records 中的旧记录")
+    parser.add_argument("--loop", type=float, default=0, help="每隔多少秒运行一次（默认只运行一次）")
+    args = parser.parse_args()
+
+    from .database import SessionLocal, init_db
+
+    init_db()
+    while True:
+        db = SessionLocal()
+        try:
+            archived = run_retention(db)
+        finally:
+            db.close()
+        print(f"✅ 归档完成，本次归档{archived}条记录，累计 {archive_store.stats()['archived']} 条")
+        if not args.loop:
+            break
+        time.sleep(args.loop)
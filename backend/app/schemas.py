@@ -2,8 +2,8 @@
 Pydantic数据模型（用于API请求和响应）
 """
 from pydantic import BaseModel, Field, validator
-from typing import Optional, Dict, Any
-from datetime import datetime
+from typing import Optional, Dict, Any, List
+from datetime import date, datetime
 
 
 class BaziRequest(BaseModel):
@@ -15,6 +15,16 @@ class BaziRequest(BaseModel):
     minute: int = Field(0, ge=0, le=59, description="出生分钟")
     timezone: str = Field("Asia/Shanghai", description="时区")
     user_id: Optional[str] = Field(None, description="用户ID（可选）")
+    longitude: Optional[float] = Field(None, ge=-180, le=180, description="出生地经度（可选，东经为正，启用真太阳时）")
+    birth_place: Optional[str] = Field(None, description="出生地（可选，未提供经度时按城市查经度）")
+    
+    @validator('birth_place')
+    def validate_birth_place(cls, v):
+        """验证出生地"""
+        from .bazi_calculator import BaziCalculator
+        if v is not None and v not in BaziCalculator.CITY_LONGITUDES:
+            raise ValueError(f"Unknown birth place: {v}")
+        return v
     
     @validator('timezone')
     def validate_timezone(cls, v):
@@ -35,7 +45,8 @@ class BaziRequest(BaseModel):
                 "hour": 14,
                 "minute": 30,
                 "timezone": "Asia/Shanghai",
-                "user_id": "user123"
+                "user_id": "user123",
+                "birth_place": "北京"
             }
         }
 
@@ -71,6 +82,8 @@ class BaziResponse(BaseModel):
     id: Optional[int] = Field(None, description="记录ID")
     birth_time: str = Field(..., description="出生时间")
     timezone: str = Field(..., description="时区")
+    longitude: Optional[float] = Field(None, description="出生地经度")
+    true_solar_time: Optional[str] = Field(None, description="真太阳时（提供经度时）")
     year_pillar: str = Field(..., description="年柱")
     month_pillar: str = Field(..., description="月柱")
     day_pillar: str = Field(..., description="日柱")
@@ -114,6 +127,8 @@ class BaziRecordResponse(BaseModel):
     birth_hour: int
     birth_minute: int
     timezone: str
+    longitude: Optional[float] = None
+    birth_place: Optional[str] = None
     year_pillar: str
     month_pillar: str
     day_pillar: str
@@ -128,6 +143,46 @@ class BaziRecordResponse(BaseModel):
         orm_mode = True
 
 
+RECORD_FIELDS = list(BaziRecordResponse.model_fields)
+
+
+def parse_record_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """
+    解析 fields 参数（逗号分隔的字段名）
+    
+    Returns:
+        字段列表（始终包含id，保持响应字段顺序）；未指定时返回None表示全部字段
+    """
+    if not fields:
+        return None
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - set(RECORD_FIELDS)
+    if unknown:
+        raise ValueError(f"未知字段: {', '.join(sorted(unknown))}")
+    requested.add("id")
+    return [name for name in RECORD_FIELDS if name in requested]
+
+
+class StatsBucket(BaseModel):
+    """统计分桶"""
+    bucket: str = Field(..., description="日期（day）或年月（month）")
+    count: int = Field(..., description="记录数")
+
+
+class StatsResponse(BaseModel):
+    """统计结果"""
+    start: Optional[date] = Field(None, description="开始日期")
+    end: Optional[date] = Field(None, description="结束日期")
+    user_id: Optional[str] = Field(None, description="用户ID")
+    bucket: str = Field(..., description="分桶粒度")
+    total: int = Field(..., description="记录总数")
+    volume: List[StatsBucket] = Field(..., description="各时间桶记录数")
+    rigan: Dict[str, int] = Field(..., description="日主分布")
+    strongest: Dict[str, int] = Field(..., description="最旺五行分布")
+    weakest: Dict[str, int] = Field(..., description="最弱五行分布")
+    wuxing: Dict[str, Dict[str, int]] = Field(..., description="各五行个数直方图")
+
+
 class HealthCheckResponse(BaseModel):
     """健康检查响应"""
     status: str = Field(..., description="状态")
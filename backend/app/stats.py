@@ -0,0 +1,223 @@
+"""
+统计计数
+创建/删除记录时在同一事务中增量更新计数表，查询只需扫描日期桶
+
+重建计数：python -m app.stats rebuild
+"""
+from collections import Counter
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+import sys
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+from . import models, retention
+
+# 全部用户的汇总行
+ALL_USERS = ""
+
+WUXING_ELEMENTS = ('木', '火', '土', '金', '水')
+
+_KEY_COLUMNS = ('bucket', 'user_id', 'dimension', 'value')
+
+
+def record_dimensions(rigan: str, wuxing_analysis: Optional[Dict]) -> List[Tuple[str, str]]:
+    """一条记录对应的统计维度：记录数、日主分布、最旺/最弱五行、各五行个数直方图"""
+    dimensions = [("volume", ""), ("rigan", rigan)]
+    if wuxing_analysis:
+        dimensions.append(("strongest", wuxing_analysis['strongest']))
+        dimensions.append(("weakest", wuxing_analysis['weakest']))
+        for element, count in wuxing_analysis['count'].items():
+            dimensions.append((f"wuxing:{element}", str(count)))
+    return dimensions
+
+
+def _counter_rows(bucket: date, user_id: Optional[str], dimensions: Iterable[Tuple[str, str]]) -> List[Tuple]:
+    scopes = [ALL_USERS] + ([user_id] if user_id else [])
+    return [(bucket, scope, dimension, value) for scope in scopes for dimension, value in dimensions]
+
+
+def _increment(db: Session, keys: List[Tuple], delta: int):
+    """批量累加计数（按数据库类型使用原生upsert）"""
+    if not keys:
+        return
+    table = models.BaziStat.__table__
+    rows = [dict(zip(_KEY_COLUMNS, key), count=delta) for key in keys]
+    dialect = db.get_bind().dialect.name
+
+    if dialect in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update(count=table.c.count + stmt.inserted.count)
+    elif dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(_KEY_COLUMNS),
+            set_={"count": table.c.count + stmt.excluded.count}
+        )
+    else:
+        for row in rows:
+            updated = db.query(models.BaziStat).filter_by(
+                **{name: row[name] for name in _KEY_COLUMNS}
+            ).update({models.BaziStat.count: models.BaziStat.count + delta})
+            if not updated:
+                db.add(models.BaziStat(**row))
+        return
+    db.execute(stmt)
+
+
+def apply_record(db: Session, record: models.BaziRecord, delta: int, wuxing_analysis: Optional[Dict] = None):
+    """
+    按记录更新计数（delta=1 创建，delta=-1 删除），不提交事务
+
+    Args:
+        wuxing_analysis: 五行分析；未提供时从记录读取
+    """
+    if wuxing_analysis is None:
+        wuxing_analysis = record.resolve('wuxing_analysis')
+    keys = _counter_rows(
+        record.created_at.date(),
+        record.user_id,
+        record_dimensions(record.rigan, wuxing_analysis)
+    )
+    _increment(db, keys, delta)
+
+
+def _lock_stats_table(db: Session):
+    """
+    在当前事务中清空计数表并持有锁，直到重建提交
+
+    并发的创建/删除要么在加锁前已提交（随后的扫描能看到），
+    要么等待重建提交后再把增量累加到新计数上，不会丢失
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        # 扫描热表与归档时使用同一快照
+        db.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+        db.execute(text("LOCK TABLE bazi_stats IN EXCLUSIVE MODE"))
+    # MySQL（REPEATABLE READ）的 DELETE 对整表加记录锁与间隙锁；SQLite 开始写事务后独占写入
+    db.query(models.BaziStat).delete()
+
+
+def rebuild_stats(db: Session, batch_size: int = 1000) -> int:
+    """
+    清空并按现有记录（热表与归档）重建计数表，返回处理的记录数
+
+    重建期间计数表被锁住，创建/删除记录会等待重建完成
+    """
+    counter: Counter = Counter()
+    processed = 0
+    record, chart = models.BaziRecord, models.BaziChart
+    _lock_stats_table(db)
+    query = db.query(
+        record.user_id,
+        record.rigan,
+        record.created_at,
+        record.wuxing_analysis,
+        chart.wuxing_analysis
+    ).outerjoin(chart, chart.id == record.chart_id).order_by(record.id).yield_per(batch_size)
+
+    for user_id, rigan, created_at, wuxing_analysis, chart_wuxing_analysis in query:
+        counter.update(_counter_rows(
+            created_at.date(),
+            user_id,
+            record_dimensions(rigan, wuxing_analysis or chart_wuxing_analysis)
+        ))
+        processed += 1
+
+    # 归档记录已移出热表但仍计入统计；归档中断时可能同时存在于热表，以热表为准
+    for rows in retention.archive_store.iter_segments():
+        ids = [row['id'] for row in rows]
+        hot = {record_id for (record_id,) in db.query(record.id).filter(record.id.in_(ids))}
+        for row in rows:
+            if row['id'] in hot:
+                continue
+            counter.update(_counter_rows(
+                row['created_at'].date(),
+                row['user_id'],
+                record_dimensions(row['rigan'], row['wuxing_analysis'])
+            ))
+            processed += 1
+
+    rows = [dict(zip(_KEY_COLUMNS, key), count=count) for key, count in counter.items()]
+    for start in range(0, len(rows), batch_size):
+        db.execute(models.BaziStat.__table__.insert(), rows[start:start + batch_size])
+    db.commit()
+    return processed
+
+
+def query_stats(
+    db: Session,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    user_id: Optional[str] = None,
+    bucket: str = "day"
+) -> Dict:
+    """
+    查询统计结果
+
+    Args:
+        start, end: 日期范围（含两端）
+        user_id: 只统计该用户；为空时统计全部用户
+        bucket: 记录数的分桶粒度，day 或 month
+    """
+    stat = models.BaziStat
+    query = db.query(stat.bucket, stat.dimension, stat.value, func.sum(stat.count)).filter(
+        stat.user_id == (user_id or ALL_USERS)
+    )
+    if start:
+        query = query.filter(stat.bucket >= start)
+    if end:
+        query = query.filter(stat.bucket <= end)
+    rows = query.group_by(stat.bucket, stat.dimension, stat.value).all()
+
+    volume: Counter = Counter()
+    distributions: Dict[str, Counter] = {"rigan": Counter(), "strongest": Counter(), "weakest": Counter()}
+    wuxing: Dict[str, Counter] = {element: Counter() for element in WUXING_ELEMENTS}
+
+    for day, dimension, value, count in rows:
+        count = int(count)
+        if dimension == "volume":
+            key = day.isoformat() if bucket == "day" else day.strftime("%Y-%m")
+            volume[key] += count
+        elif dimension in distributions:
+            distributions[dimension][value] += count
+        elif dimension.startswith("wuxing:"):
+            wuxing[dimension.split(":", 1)[1]][value] += count
+
+    return {
+        "start": start,
+        "end": end,
+        "user_id": user_id,
+        "bucket": bucket,
+        "total": sum(volume.values()),
+        "volume": [{"bucket": key, "count": volume[key]} for key in sorted(volume) if volume[key]],
+        "rigan": {key: value for key, value in distributions["rigan"].items() if value},
+        "strongest": {key: value for key, value in distributions["strongest"].items() if value},
+        "weakest": {key: value for key, value in distributions["weakest"].items() if value},
+        "wuxing": {
+            element: {key: value for key, value in sorted(counts.items(), key=lambda item: int(item[0])) if value}
+            for element, counts in wuxing.items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("用法: python -m app.stats rebuild")
+        sys.exit(1)
+
+    from .database import SessionLocal, init_db
+
+    init_db()
+    db = SessionLocal()
+    try:
+        total = rebuild_stats(db)
+    finally:
+        db.close()
+    print(f"✅ 统计重建完成，共处理{total}条记录")